@@ -1,33 +1,82 @@
 import numpy as np
 import pandas as pd
-from scipy.ndimage import label, generate_binary_structure
+from scipy.ndimage import label, generate_binary_structure, binary_erosion, find_objects
 
 
 def Separate_NonFluid_Connections(volume, fluid_default=1):
-    # Collect sub-arrays
-    original_array = volume.copy()
+    # Sub-arrays of the connected non-fluid groups, with the full volume shape. They are created only
+    # when accessed: keeping every one of them in memory costs one volume per group
+    components = SolidComponents(volume, fluid_default, full_size=True)
+    return components, components.connected_labels, components.labels
 
-    # Collect every cell with 'A' as 1, otherwise 0
-    solid_volume = (original_array != fluid_default).astype(np.uint8)
+def Separate_NonFluid_Bounding_Boxes(volume, fluid_default=1, padding=0):
+    """
+    Separates the connected non-fluid groups as Separate_NonFluid_Connections, but each sub-array
+    is cropped to the bounding box of its group (plus padding, limited by the domain).
+
+    Returns:
+        tuple: Cropped sub-arrays (created when accessed), their slices in the volume, the connected
+               labels and the labels.
+    """
+    components = SolidComponents(volume, fluid_default, padding=padding)
+    return components, components.slices, components.connected_labels, components.labels
+
+def Label_NonFluid_Connections(volume, fluid_default=1):
+    """
+    Labels the connected non-fluid groups (18-connectivity) with the smallest unsigned integer type
+    able to hold the number of groups.
+
+    Returns:
+        tuple: Connected labels (0 on fluid) and the number of groups.
+    """
     s = generate_binary_structure(rank=3, connectivity=2)
-    connected_labels, num_features = label(solid_volume, structure=s)
-    connected_labels = connected_labels.astype(np.uint8)
-
-    sub_arrays = []
-    labels = range(1, num_features + 1)
-    for label_value in labels:
-        
-        # Which cells belong to this group
-        mask = (connected_labels == label_value)
-        
-        # Replace non-matching regions with 'fluid_default
-        sub_array = np.where(mask, original_array, fluid_default)
-        sub_array = sub_array.astype(np.uint8)
-        
-        # Save result
-        sub_arrays.append(sub_array)
-
-    return sub_arrays, connected_labels, labels
+    connected_labels, num_features = label(volume != fluid_default, structure=s)
+    return connected_labels.astype(Smallest_Label_Dtype(num_features), copy=False), num_features
+
+def Smallest_Label_Dtype(max_label):
+    # Smallest unsigned type holding labels up to max_label (uint8 silently wraps above 255 groups)
+    return np.min_scalar_type(max(int(max_label), 0))
+
+class SolidComponents:
+    """
+    Lazy sequence of the connected non-fluid groups of a volume. Labels and bounding boxes are computed
+    once; the sub-array of a group (other groups replaced by fluid) is only built when it is accessed,
+    cropped to the bounding box plus padding, or with the volume shape if full_size.
+    """
+
+    def __init__(self, volume, fluid_default=1, padding=0, full_size=False):
+        self.volume = volume
+        self.fluid_default = fluid_default
+        self.full_size = full_size
+        self.connected_labels, num_features = Label_NonFluid_Connections(volume, fluid_default)
+        self.labels = range(1, num_features + 1)
+
+        # Expand bounding boxes by the padding, inside the domain
+        self.slices = [tuple(slice(max(sl.start - padding, 0), min(sl.stop + padding, dim))
+                             for sl, dim in zip(bounding_box, volume.shape))
+                       for bounding_box in find_objects(self.connected_labels)]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        label_value = self.labels[index]
+        bounding_box = self.slices[label_value - 1]
+
+        # Replace the cells of other groups with fluid, only inside the crop
+        mask = (self.connected_labels[bounding_box] == label_value)
+        sub_array = np.where(mask, self.volume[bounding_box], self.fluid_default).astype(np.uint8)
+        if not self.full_size:
+            return sub_array
+
+        full_array = np.full(self.volume.shape, self.fluid_default, dtype=np.uint8)
+        full_array[bounding_box] = sub_array
+        return full_array
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
 def Get_Neighbors(array, i, j, k):
     dim = array.shape
@@ -42,53 +91,79 @@ def Get_Neighbors(array, i, j, k):
     back = array[i-1][j][k] if i > 0 else None
     return [top, bottom, left, right, front, back]
 
-def Remove_Internal_Solid(array, fluid_default_value=1):
+def Remove_Internal_Solid(array, fluid_default_value=1, connectivity=6, slab_size=None, out=None):
+    """
+    Keeps only the solid cells in contact with fluid (or with the domain boundary), setting the
+    internal solid cells to fluid. Sample cells are never removed.
+
+    Parameters:
+        array (np.ndarray): 3D volume (can be a np.memmap).
+        fluid_default_value (int): Value of the fluid cells.
+        connectivity (int): Neighbors checked for fluid contact (6, 18 or 26).
+        slab_size (int): If given, the volume is processed in slabs of slab_size planes along
+                         the first axis (plus a one-voxel halo), so that only one slab is in memory.
+        out (np.ndarray): Output array (can be a np.memmap). Defaults to a copy of array.
+
+    Returns:
+        np.ndarray: Volume with only the solid surface cells.
+    """
+    structure = Get_Connectivity_Structure(connectivity)
+
     # Create array to work on
-    new_array = array.copy()
-    
-    # Iterate over dimensions
-    dim = array.shape
-    for i in range(dim[0]):
-        for j in range(dim[1]):
-            for k in range(dim[2]):
+    if out is None:
+        out = np.empty(array.shape, dtype=array.dtype)
 
-                # If the current cell is a solid (not fluid):
-                if array[i][j][k] != fluid_default_value:
+    n_planes = array.shape[0]
+    if slab_size is None:
+        slab_size = n_planes
 
-                    neighbors = Get_Neighbors(array, i, j, k)
+    for start in range(0, n_planes, slab_size):
+        stop = min(start + slab_size, n_planes)
+        # One-voxel halo on each side, except at the domain boundary
+        halo_start = max(start - 1, 0)
+        halo_stop = min(stop + 1, n_planes)
+        slab = np.asarray(array[halo_start:halo_stop])
 
-                    # If any neighbor is fluid or None (boundary), the cell is not internal solid
-                    # If not, it is an internal solid and must be set to fluid
-                    if any((n == fluid_default_value) or (n is None) for n in neighbors):
-                        continue  # Keep the current solid cell
-                    else:
-                        # Set internal solid to fluid
-                        new_array[i][j][k] = fluid_default_value
-    
-    # Return all samples to original cells: samples should not be removed with internal solid
-    mask_sample_cells = ~np.isin(array, [1, 0])
-    new_array[mask_sample_cells] = array[mask_sample_cells]
+        internal = _Internal_Solid_Mask(slab, fluid_default_value, structure)
+        inner = slice(start - halo_start, stop - halo_start)
+        new_slab = slab[inner].copy()
+        new_slab[internal[inner]] = fluid_default_value
+        out[start:stop] = new_slab
 
-    return new_array
+    return out
+
+def Get_Connectivity_Structure(connectivity):
+    # 6: faces, 18: faces and edges, 26: faces, edges and corners
+    connectivity_levels = {6: 1, 18: 2, 26: 3}
+    if connectivity not in connectivity_levels:
+        raise ValueError("Invalid connectivity: choose 6, 18, or 26")
+    return generate_binary_structure(rank=3, connectivity=connectivity_levels[connectivity])
+
+def _Internal_Solid_Mask(array, fluid_default_value, structure):
+    # A solid cell is internal if all its neighbors are solid. Outside the domain counts as
+    # non-solid (border_value=0), so boundary cells are never internal.
+    solid = (array != fluid_default_value)
+    internal = binary_erosion(solid, structure=structure, border_value=0)
+
+    # Samples should not be removed with internal solid
+    sample_cells = (array != 1) & (array != 0)
+    internal &= ~sample_cells
+    return internal
 
 
 
 def df_to_3d_array(df, x_col='x', y_col='y', z_col='z', angle_col='angle'):
 
-    # Determinar os tamanhos do array 3D
-    x_size = int(df['x'].max())
-    y_size = int(df['y'].max())
-    z_size = int(df['z'].max())
+    # Determinar os tamanhos do array 3D (indices de 0 ate o maximo)
+    x = np.asarray(df[x_col]).astype(np.intp)
+    y = np.asarray(df[y_col]).astype(np.intp)
+    z = np.asarray(df[z_col]).astype(np.intp)
 
     # Inicializar o array 3D com NaNs
-    array_3d = np.full((x_size, y_size, z_size), np.nan)
+    array_3d = np.full((x.max() + 1, y.max() + 1, z.max() + 1), np.nan)
 
-    # Preencher o array com os valores de angle
-    for _, row in df.iterrows():
-        x = int(row['x'])
-        y = int(row['y'])
-        z = int(row['z'])
-        array_3d[x, y, z] = row[angle_col]
+    # Preencher o array com os valores de angle, todos de uma vez
+    array_3d[x, y, z] = np.asarray(df[angle_col])
 
     return array_3d
 
@@ -97,32 +172,36 @@ def df_to_3d_array(df, x_col='x', y_col='y', z_col='z', angle_col='angle'):
 
 
 def array3D_to_dataframe(volume, volume_shape, remove_where_value=1.):
+    # DataFrame with the coordinates (x, y, z) and value of every cell different from remove_where_value.
+    # Only these cells are collected, without coordinate grids of the whole volume
+    volume = np.asarray(volume).reshape(volume_shape)
+    cells = np.nonzero(volume != remove_where_value)
 
-    # Gere grades de coordenadas 3D (x, y, z)
-    x_coords = np.arange(volume_shape[0])  # Coordenadas x
-    y_coords = np.arange(volume_shape[1])  # Coordenadas y
-    z_coords = np.arange(volume_shape[2])  # Coordenadas z
-
-    # Crie matrizes 3D de coordenadas para cada eixo
-    x_grid, y_grid, z_grid = np.meshgrid(
-        x_coords, y_coords, z_coords, indexing="ij")
+    # Crie o DataFrame com as colunas x, y, z e value (indice: posicao da celula no volume achatado)
+    df = pd.DataFrame({
+        'x': cells[0],
+        'y': cells[1],
+        'z': cells[2],
+        'angle': volume[cells]
+    }, index=np.ravel_multi_index(cells, volume_shape))
+    return df
 
-    # Achate (flatten) os arrays 3D para 1D para formar as colunas
-    x_flat = x_grid.ravel()  # Coordenadas x achatadas
-    y_flat = y_grid.ravel()  # Coordenadas y achatadas
-    z_flat = z_grid.ravel()  # Coordenadas z achatadas
-    values_flat = volume.ravel()  # Valores do volume achatados
+def Extract_Samples(volume, fluid_default_value=1, solid_default_value=0, as_dataframe=False):
+    """
+    Collects the sample cells of volume (neither fluid, solid nor 1) directly from the array.
 
-    # Crie o DataFrame com as colunas x, y, z e value
-    df = pd.DataFrame({
-        'x': x_flat,
-        'y': y_flat,
-        'z': z_flat,
-        'angle': values_flat
-    })
+    Parameters:
+        volume (np.ndarray): 3D volume.
+        fluid_default_value (int): Value of the fluid cells.
+        solid_default_value (int): Value of the solid cells without samples.
+        as_dataframe (bool): If True, a DataFrame is returned instead of a dictionary.
 
-    df = df[df["angle"] != remove_where_value]
-    return df
+    Returns:
+        dict: Arrays 'x', 'y', 'z' (cell indices) and 'angle' (sample values), in volume order.
+    """
+    cells = np.nonzero((volume != fluid_default_value) & (volume != solid_default_value) & (volume != 1))
+    samples = {'x': cells[0], 'y': cells[1], 'z': cells[2], 'angle': np.asarray(volume[cells])}
+    return pd.DataFrame(samples) if as_dataframe else samples
 
 def RandomCube(mean1, mean2, x_bins, y_bins, z_bins, cube_size):
     """
@@ -163,37 +242,36 @@ def RandomCube(mean1, mean2, x_bins, y_bins, z_bins, cube_size):
     return array_3d
 
 def separate_into_cubes(df, x_bins, y_bins, z_bins, cube_size):
+    """
+    Splits the samples of df into the sub-cubes defined by the bin edges (intervals [left, right)),
+    adding the limits of its sub-cube to each sample. Samples outside the bins are dropped.
 
-    # Criar colunas categóricas para x, y e z
-    df['x_bin'] = pd.cut(df['x'], bins=x_bins,
-                         right=False, include_lowest=True)
-    df['y_bin'] = pd.cut(df['y'], bins=y_bins,
-                         right=False, include_lowest=True)
-    df['z_bin'] = pd.cut(df['z'], bins=z_bins,
-                         right=False, include_lowest=True)
-
-    # Inicializar dicionário para armazenar os sub-cubos
-    sub_dataframes = []
-
-    # Iterar sobre os bins únicos de cada eixo
-    for x_bin in df['x_bin'].cat.categories:
-        for y_bin in df['y_bin'].cat.categories:
-            for z_bin in df['z_bin'].cat.categories:
-                # Filtrar o DataFrame para obter os dados do sub-cubo atual
-                sub_df = df[(df['x_bin'] == x_bin) & (
-                    df['y_bin'] == y_bin) & (df['z_bin'] == z_bin)]
-
-                if not sub_df.empty:
-                    # Adicionar colunas para os limites de cada bin
-                    sub_df = sub_df[['x', 'y', 'z', 'angle']].copy()
-                    sub_df['x_min'] = x_bin.left
-                    sub_df['x_max'] = x_bin.right
-                    sub_df['y_min'] = y_bin.left
-                    sub_df['y_max'] = y_bin.right
-                    sub_df['z_min'] = z_bin.left
-                    sub_df['z_max'] = z_bin.right
-
-                    # Armazenar o sub-DataFrame na lista
-                    sub_dataframes.append(sub_df)
-
-    return sub_dataframes.copy()
+    Returns:
+        list: One DataFrame per non-empty sub-cube, in x, y, z bin order.
+    """
+    x_bins, y_bins, z_bins = np.asarray(x_bins), np.asarray(y_bins), np.asarray(z_bins)
+    bins_shape = (len(x_bins) - 1, len(y_bins) - 1, len(z_bins) - 1)
+
+    # Bin de cada amostra em cada eixo, calculado uma unica vez
+    bin_index = [np.searchsorted(bins, np.asarray(df[column]), side='right') - 1
+                 for bins, column in zip((x_bins, y_bins, z_bins), ('x', 'y', 'z'))]
+    inside = np.all([(index >= 0) & (index < n_bins) for index, n_bins in zip(bin_index, bins_shape)], axis=0)
+
+    # Agrupar as amostras por sub-cubo (ordenacao estavel: a ordem original e mantida em cada sub-cubo)
+    rows = np.nonzero(inside)[0]
+    cube = np.ravel_multi_index(tuple(index[rows] for index in bin_index), bins_shape)
+    order = np.argsort(cube, kind='stable')
+    rows, cube = rows[order], cube[order]
+    _, cube_starts = np.unique(cube, return_index=True)
+
+    # Um unico DataFrame ordenado por sub-cubo, com os limites de cada bin, dividido em fatias
+    i, j, k = np.unravel_index(cube, bins_shape)
+    sorted_df = df[['x', 'y', 'z', 'angle']].iloc[rows].copy()
+    sorted_df['x_min'], sorted_df['x_max'] = x_bins[i], x_bins[i + 1]
+    sorted_df['y_min'], sorted_df['y_max'] = y_bins[j], y_bins[j + 1]
+    sorted_df['z_min'], sorted_df['z_max'] = z_bins[k], z_bins[k + 1]
+
+    cube_stops = np.append(cube_starts[1:], len(rows))
+    sub_dataframes = [sorted_df.iloc[start:stop].copy() for start, stop in zip(cube_starts, cube_stops)]
+
+    return sub_dataframes
@@ -0,0 +1,148 @@
+import contextlib
+import datetime
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak resident memory is not recorded
+    resource = None
+
+# Run state: None while instrumentation is disabled, so that every call returns after a single check
+_state = None
+_DISABLED = contextlib.nullcontext()
+
+
+def Enable_Instrumentation(trace_memory=False):
+    """
+    Starts recording timers and counters (previous records are discarded).
+
+    Parameters:
+        trace_memory (bool): Also record the tracemalloc peak of each timer (slows down allocations).
+    """
+    global _state
+    Disable_Instrumentation()
+    _state = {"timers": {}, "counters": {}, "stack": [], "trace_memory": trace_memory, "started_tracemalloc": False,
+              "start": time.perf_counter()}
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state["started_tracemalloc"] = True
+
+def Disable_Instrumentation():
+    global _state
+    if _state is not None and _state["started_tracemalloc"]:
+        tracemalloc.stop()
+    _state = None
+
+def Instrumentation_Enabled():
+    # For callers that need extra work (e.g. a pass over the volume) only to record a counter
+    return _state is not None
+
+
+def Timer(name):
+    """
+    Context manager adding the duration of its block to the timer name, nested under the timers
+    already running (e.g. "interpolate_solid/kriging").
+    """
+    return _DISABLED if _state is None else _Timer(name)
+
+def Timed(name=None):
+    # Decorator: the whole function runs inside Timer(name), by default the function name
+    def decorator(function):
+        timer_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _state is None:
+                return function(*args, **kwargs)
+            with _Timer(timer_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def Count(name, value=1):
+    # Adds value to the counter name
+    if _state is None:
+        return
+    _state["counters"][name] = _state["counters"].get(name, 0) + value
+
+
+class _Timer:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _state["stack"]
+        self.path = "/".join([frame.path for frame in stack[-1:]] + [self.name])
+        self.peak = 0
+        if _state["trace_memory"]:
+            # The running timer keeps its peak so far, and the peak is restarted for this one
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        _state["stack"].pop()
+
+        record = _state["timers"].setdefault(self.path, {"calls": 0, "total_s": 0.0})
+        record["calls"] += 1
+        record["total_s"] += elapsed
+        record["max_rss_bytes"] = Peak_RSS()
+        if _state["trace_memory"]:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record["tracemalloc_peak_bytes"] = max(record.get("tracemalloc_peak_bytes", 0), self.peak)
+            if _state["stack"]:
+                _state["stack"][-1].peak = max(_state["stack"][-1].peak, self.peak)
+        return False
+
+
+def Peak_RSS():
+    # High-water mark of the resident memory of this process, in bytes (ru_maxrss is in kB on Linux), or None
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def Run_Report(**metadata):
+    """
+    Timers, counters and peak memory recorded since Enable_Instrumentation, with the given metadata.
+    Timers of worker processes are not included.
+    """
+    if _state is None:
+        return {}
+    return {**metadata,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "wall_time_s": time.perf_counter() - _state["start"],
+            "peak_rss_bytes": Peak_RSS(),
+            "timers": _state["timers"],
+            "counters": _state["counters"]}
+
+def Write_Run_Report(file_name, **metadata):
+    # Verificar se a pasta existe, caso contrário, criar
+    folder = os.path.dirname(file_name)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(file_name, "w") as file:
+        json.dump(Run_Report(**metadata), file, indent=4)
+
+@contextlib.contextmanager
+def Instrumented_Run(report_file_name, trace_memory=False, **metadata):
+    """
+    Records the timers and counters of the block and writes them as a JSON report (also if the
+    block fails), e.g. one report per processed volume.
+    """
+    Enable_Instrumentation(trace_memory)
+    try:
+        yield
+    finally:
+        Write_Run_Report(report_file_name, **metadata)
+        Disable_Instrumentation()
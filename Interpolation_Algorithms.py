@@ -1,14 +1,34 @@
 import Plotter as pl
 import numpy as np
-from Array_Utilities import Separate_NonFluid_Connections, Remove_Internal_Solid, array3D_to_dataframe
+import inspect
+from Array_Utilities import Separate_NonFluid_Bounding_Boxes, Remove_Internal_Solid, Extract_Samples, Label_NonFluid_Connections
 from pykrige.uk3d import UniversalKriging3D
-from sklearn.neighbors import NearestNeighbors
-import os
-
-def interpolate_solid(volume, fluid_default_value=1, file_name=""):
-    print("-Full Volume (with Surface), sample cells: ", np.sum((volume != 0) & (volume != 1)))
-    print("-Full Volume (with Surface), fluid cells: ", np.sum((volume == 1)))
-    print("-Full Volume (with Surface), solid cells: ", np.sum((volume == 0)))
+from Kriging_Algorithms import LocalKriging3D, KrigingOperator, Execute_Kriging_Tiles, Cross_Validate_Variogram
+from Parallel_Utilities import Create_Shared_Array, Attach_Shared_Array, Release_Shared_Arrays
+from Path_Planning_Algorithms import Dijkstra3D
+from Volume_IO import Create_Volume, Save_Volume, Volume_Slabs
+from Slab_Pipeline import interpolate_solid_connection_surfaces_slabs
+from Instrumentation import Timer, Timed, Count
+from scipy.ndimage import distance_transform_edt, find_objects
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from concurrent.futures import ProcessPoolExecutor
+
+@Timed()
+def interpolate_solid(volume, fluid_default_value=1, file_name="", krige_only_solid=True, kriging_neighbors=None, kriging_radius=None,
+                      kriging_workers=1, krig_out=None, nn_out=None, knn_filter=None, knn_neighbors=5, knn_radius=None,
+                      variogram_models=["linear"]):
+    """
+    Interpolates the samples of volume over its solid cells with Kriging and Nearest Neighbor.
+
+    If knn_filter ("mean", "median" or "idw") is given, the sample angles are first smoothed with their
+    knn_neighbors nearest samples, optionally within knn_radius (Filtra_KNN). The kriging variogram is
+    the best of variogram_models (Apply_Kriging).
+
+    krig_out and nn_out are optional output arrays with the volume shape (e.g. views of a larger volume):
+    only their solid cells are written. By default, copies of volume are returned, memory-mapped on the
+    output files if file_name is given.
+    """
     volume_shape = volume.shape
 
     # Coleta o sub domínio em analise
@@ -17,107 +37,429 @@ def interpolate_solid(volume, fluid_default_value=1, file_name=""):
     z_lim = 0, volume_shape[2]
     
     
-    # Convert array to dataframe in order to apply interpolation methods
-    df_volume = array3D_to_dataframe(volume, volume_shape, remove_where_value=fluid_default_value)
-
-    # Remove rock(value=0) and fluid(value=1) voxels that do not influence interpolation
-    df_reads_volume = df_volume[(df_volume['angle'] != 1) & (df_volume['angle'] != 0)]
-    if df_reads_volume.empty: raise ValueError("Empty dataframe. Make sure to provide samples for interpolation")
+    # Collect the sample cells: rock(value=0) and fluid(value=1) voxels do not influence interpolation
+    with Timer("sample_extraction"):
+        samples = Extract_Samples(volume, fluid_default_value=fluid_default_value)
+    print("-Volume sample cells: ", samples['angle'].size)
+    Count("samples", samples['angle'].size)
+    if samples['angle'].size == 0: raise ValueError("No sample cells. Make sure to provide samples for interpolation")
+    if knn_filter is not None:
+        with Timer("knn_filter"):
+            samples = Filtra_KNN(samples, K=knn_neighbors, mode=knn_filter, radius=knn_radius)
     
-    # Create a complete block with interpolated values
-    krig_domain = Apply_Kriging(df_reads_volume, n_points=5, tested_methods=["linear"], x_lim=x_lim, y_lim=y_lim, z_lim=z_lim)
-    nn_domain = Apply_NearestNeighbor(df_reads_volume)
+    # Create blocks with interpolated values: only on the solid cells, or on the complete block
+    target_mask = (volume != fluid_default_value) if krige_only_solid else None
+    krig_domain = Apply_Kriging(samples, n_points=5, tested_methods=variogram_models, x_lim=x_lim, y_lim=y_lim, z_lim=z_lim, target_mask=target_mask,
+                                n_neighbors=kriging_neighbors, search_radius=kriging_radius, n_workers=kriging_workers)
+    nn_domain = Apply_NearestNeighbor(samples, x_lim=x_lim, y_lim=y_lim, z_lim=z_lim, target_mask=target_mask)
     
     # Remove fluid cells from the complete 3D interpolated block, only solid cells must be interpolated
-    krig_final_domain = limit_interpolation_to_solid(volume, krig_domain, fluid_default_value)
-    nn_final_domain = limit_interpolation_to_solid(volume, nn_domain, fluid_default_value)
-    
-    # Ensure unsigned char cells
-    krig_final_domain = krig_final_domain.astype(np.uint8)
-    nn_final_domain = nn_final_domain.astype(np.uint8)
+    with Timer("merge"):
+        krig_out = _output_volume(krig_out, _output_file_name(file_name, "_krig.raw"), volume, fluid_default_value, initialize=krig_out is None)
+        nn_out = _output_volume(nn_out, _output_file_name(file_name, "_nn.raw"), volume, fluid_default_value, initialize=nn_out is None)
+        krig_final_domain = limit_interpolation_to_solid(volume, krig_domain, fluid_default_value, out=krig_out)
+        nn_final_domain = limit_interpolation_to_solid(volume, nn_domain, fluid_default_value, out=nn_out)
 
     if file_name != "":
-        # Verificar se a pasta existe, caso contrário, criar
-        folder = os.path.dirname(file_name)
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
-        
-        krig_final_domain.tofile(file_name+"_krig.raw")
-        nn_final_domain.tofile(file_name+"_nn.raw")
+        with Timer("write"):
+            Save_Volume(file_name+"_krig.raw", krig_final_domain, fluid_default_value)
+            Save_Volume(file_name+"_nn.raw", nn_final_domain, fluid_default_value)
 
     return krig_final_domain, nn_final_domain
 
 
-def interpolate_solid_connections(volume, fluid_default=1, file_name="", make_plot=True):
-    # Separate full solid into sub-solid with connected cells
-    sub_arrays, connected_labels, labels = Separate_NonFluid_Connections(volume, fluid_default)
+@Timed()
+def interpolate_solid_connections(volume, fluid_default=1, file_name="", make_plot=True, crop_padding=0, n_workers=1, kriging_workers=1,
+                                  krig_out=None, nn_out=None, cache=None, kriging_neighbors=None, kriging_radius=None):
+    # Outputs: the given arrays (e.g. memory maps from Volume_IO), the output files or copies of volume.
+    # With a Result_Cache.ResultCache, groups whose crop (samples included) was already interpolated are read from it
+    volume_krig = _output_volume(krig_out, _output_file_name(file_name, "_SolConn_krig.raw"), volume, fluid_default)
+    volume_nn = _output_volume(nn_out, _output_file_name(file_name, "_SolConn_nn.raw"), volume, fluid_default)
+
+    # Separate full solid into sub-solid with connected cells, each cropped to its bounding box
+    with Timer("component_labelling"):
+        sub_arrays, sub_slices, connected_labels, labels = Separate_NonFluid_Bounding_Boxes(volume, fluid_default, padding=crop_padding)
 
-    # Apply kriging to each sub array
-    volume_krig = volume.copy()
-    volume_nn = volume.copy()
-    
     print("---Array diveded into ",len(sub_arrays), " sub arrays. ")
-        
-    for conn_label, sub_domain in zip(labels, sub_arrays):
-        pl.Plot_Domain(sub_domain, "EXCLUIR")
-        print("---Group ", conn_label, " with shape ",sub_domain.shape, ", Sample cells: ",np.sum((sub_domain != 0) & (sub_domain != 1)))
-        
-        # If no samples are present on the solid group: keep original 
-        if np.sum((sub_domain != 0) & (sub_domain != 1)) == 0: 
-            krig_sub_domain = sub_domain
-            nn_sub_domain = sub_domain
-        else:
-            krig_sub_domain, nn_sub_domain = interpolate_solid(sub_domain, fluid_default_value=fluid_default)
+    Count("components", len(sub_arrays))
+
+    if n_workers > 1:
+        # Each group is interpolated by a worker process, reading and writing the volumes in shared memory
+        _interpolate_solid_connections_parallel(volume, connected_labels, labels, sub_slices, volume_krig, volume_nn,
+                                                fluid_default, make_plot, n_workers, kriging_workers, cache, kriging_neighbors, kriging_radius)
+    else:
+        # Apply kriging to each sub array
+        for conn_label, sub_domain, sub_slice in zip(labels, sub_arrays, sub_slices):
+            _interpolate_solid_connection(sub_domain, conn_label, sub_slice,
+                                          volume_krig, volume_nn, fluid_default, make_plot, kriging_workers, cache,
+                                          kriging_neighbors, kriging_radius)
 
-        # Mask identify cells that belong to the interpolated group
-        mask = (connected_labels == conn_label)
-        # Substitute interpolated cells to the right spots
-        volume_krig[mask] = krig_sub_domain[mask]
-        volume_nn[mask] = nn_sub_domain[mask]
-        
     if file_name != "":
-        # Verificar se a pasta existe, caso contrário, criar
-        folder = os.path.dirname(file_name)
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
-        volume_krig.tofile(file_name+"_SolConn_krig.raw")
-        volume_nn.tofile(file_name+"_SolConn_nn.raw")
+        with Timer("write"):
+            Save_Volume(file_name+"_SolConn_krig.raw", volume_krig, fluid_default)
+            Save_Volume(file_name+"_SolConn_nn.raw", volume_nn, fluid_default)
 
     return volume_krig, volume_nn
 
 
-def interpolate_solid_connection_surfaces(volume, fluid_default=1, file_name=""):
-    print("-Full Volume (with Surface), sample cells: ", np.sum((volume != 0) & (volume != 1)))
-    volume_surface = Remove_Internal_Solid(volume)
+def _interpolate_solid_connection(sub_domain, conn_label, sub_slice, volume_krig, volume_nn, fluid_default, make_plot,
+                                  kriging_workers=1, cache=None, kriging_neighbors=None, kriging_radius=None):
+    if make_plot: pl.Plot_Domain(sub_domain, "EXCLUIR")
+    n_samples = np.sum((sub_domain != 0) & (sub_domain != 1) & (sub_domain != fluid_default))
+    print("---Group ", conn_label, " with shape ",sub_domain.shape, ", Sample cells: ", n_samples)
+
+    # If no samples are present on the solid group: keep original
+    if n_samples == 0:
+        Count("components_without_samples")
+        return
+
+    # The result of a group only depends on its crop (not on its position) and on the parameters of interpolate_solid
+    group_cells = (sub_domain != fluid_default)
+    solid_arguments = dict(fluid_default_value=fluid_default, kriging_neighbors=kriging_neighbors, kriging_radius=kriging_radius)
+    if cache is not None:
+        key = cache.key(sub_domain, method="interpolate_solid", **_Result_Parameters(interpolate_solid, solid_arguments))
+        cached = cache.get(key)
+        if cached is not None:
+            Count("cache_hits")
+            volume_krig[sub_slice][group_cells] = cached["krig"]
+            volume_nn[sub_slice][group_cells] = cached["nn"]
+            return
+        Count("cache_misses")
+
+    # The group cells are the solid cells of the crop: interpolated values are written only there,
+    # directly through views of the output volumes
+    interpolate_solid(sub_domain, kriging_workers=kriging_workers, krig_out=volume_krig[sub_slice], nn_out=volume_nn[sub_slice],
+                      **solid_arguments)
+    if cache is not None:
+        with Timer("cache_write"):
+            cache.put(key, krig=volume_krig[sub_slice][group_cells], nn=volume_nn[sub_slice][group_cells])
+
+
+def _Result_Parameters(function, arguments, ignored=("volume", "file_name", "kriging_workers", "krig_out", "nn_out")):
+    # Parameters of a call of function in effect (the given arguments and the defaults of the others),
+    # except its input, outputs and those that do not change the result
+    bound = inspect.signature(function).bind_partial(**arguments)
+    bound.apply_defaults()
+    return {name: value for name, value in bound.arguments.items() if name not in ignored}
+
+
+def _interpolate_solid_connections_parallel(volume, connected_labels, labels, sub_slices, volume_krig, volume_nn,
+                                            fluid_default, make_plot, n_workers, kriging_workers, cache=None,
+                                            kriging_neighbors=None, kriging_radius=None):
+    shared_blocks = []
+    try:
+        # Input and output volumes are shared with the workers instead of pickled
+        shared_specs = []
+        for initial in (volume, connected_labels, volume, volume):
+            shm, _, spec = Create_Shared_Array(initial.shape, initial.dtype, initial=initial)
+            shared_blocks.append(shm)
+            shared_specs.append(spec)
+
+        # Every group writes only its own cells, so the result does not depend on the order of execution
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_solid_connection_worker,
+                                 initargs=(shared_specs, fluid_default, make_plot, kriging_workers, cache,
+                                           kriging_neighbors, kriging_radius)) as executor:
+            list(executor.map(_interpolate_solid_connection_worker, labels, sub_slices))
+
+        volume_krig[...] = np.ndarray(volume.shape, dtype=volume.dtype, buffer=shared_blocks[2].buf)
+        volume_nn[...] = np.ndarray(volume.shape, dtype=volume.dtype, buffer=shared_blocks[3].buf)
+    finally:
+        Release_Shared_Arrays(shared_blocks)
+
+
+_worker_state = {}
+
+def _init_solid_connection_worker(shared_specs, fluid_default, make_plot, kriging_workers, cache, kriging_neighbors, kriging_radius):
+    # Attach once per worker process to the shared volumes
+    attached = [Attach_Shared_Array(spec) for spec in shared_specs]
+    _worker_state["blocks"] = [shm for shm, _ in attached]
+    _worker_state["volume"], _worker_state["connected_labels"], _worker_state["volume_krig"], _worker_state["volume_nn"] = [array for _, array in attached]
+    _worker_state["fluid_default"] = fluid_default
+    _worker_state["make_plot"] = make_plot
+    _worker_state["kriging_workers"] = kriging_workers
+    _worker_state["cache"] = cache
+    _worker_state["kriging_neighbors"] = kriging_neighbors
+    _worker_state["kriging_radius"] = kriging_radius
+
+
+def _interpolate_solid_connection_worker(conn_label, sub_slice):
+    fluid_default = _worker_state["fluid_default"]
+    connected_labels = _worker_state["connected_labels"]
+
+    # Crop of the group, with the other groups replaced by fluid
+    mask = (connected_labels[sub_slice] == conn_label)
+    sub_domain = np.where(mask, _worker_state["volume"][sub_slice], fluid_default).astype(np.uint8)
+
+    _interpolate_solid_connection(sub_domain, conn_label, sub_slice,
+                                  _worker_state["volume_krig"], _worker_state["volume_nn"], fluid_default, _worker_state["make_plot"],
+                                  _worker_state["kriging_workers"], _worker_state["cache"],
+                                  _worker_state["kriging_neighbors"], _worker_state["kriging_radius"])
+
+
+@Timed()
+def interpolate_solid_connection_surfaces(volume, fluid_default=1, file_name="", make_plot=False, n_workers=1, kriging_workers=1, krig_out=None,
+                                          nn_out=None, memory_budget=None, cache=None, kriging_neighbors=None, kriging_radius=None):
+    if memory_budget is not None:
+        # Out-of-core mode: the volume is processed in slabs and streamed to the output files
+        unsupported = {"make_plot": make_plot, "krig_out": krig_out is not None, "nn_out": nn_out is not None, "n_workers": n_workers != 1,
+                       "kriging_workers": kriging_workers != 1, "cache": cache is not None}
+        if any(unsupported.values()):
+            raise ValueError(f"memory_budget (slab mode) does not support {[name for name, used in unsupported.items() if used]}")
+        return interpolate_solid_connection_surfaces_slabs(volume, fluid_default=fluid_default, file_name=file_name, memory_budget=memory_budget,
+                                                           n_neighbors=kriging_neighbors, search_radius=kriging_radius)
+
+    with Timer("surface_extraction"):
+        volume_surface = Remove_Internal_Solid(volume, fluid_default_value=fluid_default)
     
-    print("-Full Volume (no Surface), sample cells: ", np.sum((volume_surface != 0) & (volume_surface != 1)))
-    volume_krig, volume_nn = interpolate_solid_connections(volume_surface, fluid_default=fluid_default) 
+    krig_out = _output_volume(krig_out, _output_file_name(file_name, "_Surface_SolConn_krig.raw"), volume_surface, fluid_default, initialize=False)
+    nn_out = _output_volume(nn_out, _output_file_name(file_name, "_Surface_SolConn_nn.raw"), volume_surface, fluid_default, initialize=False)
+    volume_krig, volume_nn = interpolate_solid_connections(volume_surface, fluid_default=fluid_default, make_plot=make_plot, n_workers=n_workers,
+                                                           kriging_workers=kriging_workers, krig_out=krig_out, nn_out=nn_out, cache=cache,
+                                                           kriging_neighbors=kriging_neighbors, kriging_radius=kriging_radius)
     
     
     if file_name != "":
-        # Verificar se a pasta existe, caso contrário, criar
-        folder = os.path.dirname(file_name)
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
-        volume_krig.tofile(file_name+"_Surface_SolConn_krig.raw")
-        volume_nn.tofile(file_name+"_Surface_SolConn_nn.raw")
+        with Timer("write"):
+            Save_Volume(file_name+"_Surface_SolConn_krig.raw", volume_krig, fluid_default)
+            Save_Volume(file_name+"_Surface_SolConn_nn.raw", volume_nn, fluid_default)
     
     return volume_krig, volume_nn
 
 
-def limit_interpolation_to_solid(volume, interpolated_domain, fluid_default_value):
+@Timed()
+def interpolate_solid_connection_surfaces_update(volume, changes, volume_krig, volume_nn, fluid_default=1, kriging_neighbors=None,
+                                                 kriging_radius=None, file_name="", block_size=8):
+    """
+    Updates a previous result of interpolate_solid_connection_surfaces after sample cells were added,
+    changed or removed, recomputing only the cells whose values can depend on the changed samples.
+    kriging_neighbors and kriging_radius must be those of the previous run (the defaults are the same).
+
+    Parameters:
+        volume (np.ndarray): Input volume of the previous result. It is updated with the changes.
+        changes (dict): Arrays 'x', 'y', 'z' and 'angle' (as Extract_Samples) with the new values of the
+                        changed cells: a sample angle, or 0 to remove a sample. The cells must be solid
+                        surface cells (in contact with fluid).
+        volume_krig, volume_nn (np.ndarray): Previous results (e.g. memory maps from Volume_IO.Open_Volume
+                                             in "r+" mode), updated in place.
+        block_size (int): Edge of the blocks of cells discarded at once by Affected_Cells.
+
+    In each group containing a changed cell, only the cells that may have a changed cell among their
+    kriging_neighbors closest samples, before or after the changes, are recomputed (this also covers
+    their nearest sample). The variogram of the group is fitted again on its new samples, as a full
+    run would do, so the cells outside that region keep the values of the previous variogram. Groups kriged
+    globally (kriging_neighbors=None) or with a single value (at most 2 samples, or equal angles) before
+    or after the changes are recomputed entirely.
+
+    Returns:
+        tuple: The updated volume_krig and volume_nn.
+    """
+    changed = tuple(np.asarray(changes[axis], dtype=np.intp) for axis in ("x", "y", "z"))
+    new_values = np.asarray(changes['angle'])
+    if np.any(np.asarray(volume[changed]) == fluid_default) or np.any(new_values == fluid_default):
+        raise ValueError("Changed cells must be solid cells, with a solid or sample value")
+    if np.any(_Internal_Cells(volume, changed, fluid_default)):
+        raise ValueError("Changed cells must be on the solid surface (in contact with fluid)")
+
+    # Cells keep being solid surface cells: the groups do not change, only their samples
+    old_values = np.asarray(volume[changed]).copy()
+    volume[changed] = new_values
+
+    with Timer("surface_extraction"):
+        volume_surface = Remove_Internal_Solid(volume, fluid_default_value=fluid_default)
+    with Timer("component_labelling"):
+        labels, _ = Label_NonFluid_Connections(volume_surface, fluid_default)
+        bounding_boxes = find_objects(labels)
+
+    changed_labels = labels[changed]
+    groups = np.unique(changed_labels)
+    print("-Updating ", changed[0].size, " changed cells in ", groups.size, " groups")
+    Count("changed_cells", changed[0].size)
+    Count("updated_components", groups.size)
+
+    for group in groups:
+        sub_slice = bounding_boxes[group - 1]
+        sub_domain = np.where(labels[sub_slice] == group, volume_surface[sub_slice], fluid_default).astype(np.uint8)
+
+        # Changed cells of the group, in crop indices, with their values before the changes
+        in_group = (changed_labels == group)
+        group_changed = tuple(axis[in_group] - bounds.start for axis, bounds in zip(changed, sub_slice))
+        old_domain = sub_domain.copy()
+        old_domain[group_changed] = old_values[in_group]
+
+        _update_solid_connection(sub_domain, old_domain, group_changed, group, volume_krig[sub_slice], volume_nn[sub_slice],
+                                 fluid_default, kriging_neighbors, kriging_radius, block_size)
+
+    if file_name != "":
+        with Timer("write"):
+            Save_Volume(file_name+"_Surface_SolConn_krig.raw", volume_krig, fluid_default)
+            Save_Volume(file_name+"_Surface_SolConn_nn.raw", volume_nn, fluid_default)
+
+    return volume_krig, volume_nn
+
+
+def _update_solid_connection(sub_domain, old_domain, changed, conn_label, krig_out, nn_out, fluid_default, kriging_neighbors,
+                             kriging_radius, block_size):
+    group_cells = (sub_domain != fluid_default)
+    samples = Extract_Samples(sub_domain, fluid_default_value=fluid_default)
+    old_samples = Extract_Samples(old_domain, fluid_default_value=fluid_default)
+    print("---Group ", conn_label, " with shape ", sub_domain.shape, ", Sample cells: ", samples['angle'].size)
+
+    # Without samples the group keeps its original cells (as in interpolate_solid_connections)
+    if samples['angle'].size == 0:
+        krig_out[group_cells] = sub_domain[group_cells]
+        nn_out[group_cells] = sub_domain[group_cells]
+        return
+
+    # Same cases of Apply_Kriging where a single value is propagated to the whole group
+    single_value = lambda angle: angle.size <= 2 or np.all(angle == angle[0])
+    if kriging_neighbors is None or single_value(samples['angle']) or single_value(old_samples['angle']):
+        interpolate_solid(sub_domain, fluid_default_value=fluid_default, kriging_neighbors=kriging_neighbors,
+                          kriging_radius=kriging_radius, krig_out=krig_out, nn_out=nn_out)
+        return
+
+    sample_points = np.column_stack((samples['x'], samples['y'], samples['z']))
+    old_sample_points = np.column_stack((old_samples['x'], old_samples['y'], old_samples['z']))
+    with Timer("affected_cells"):
+        targets = np.column_stack(np.nonzero(group_cells))
+        targets = targets[Affected_Cells(targets, np.column_stack(changed), (old_sample_points, sample_points),
+                                         kriging_neighbors, block_size)]
+    print("---Recomputed cells: ", len(targets), " of ", np.count_nonzero(group_cells))
+    Count("kriging_targets", len(targets))
+    Count("kriging_systems", len(targets))
+    Count("nearest_neighbor_targets", len(targets))
+    if len(targets) == 0:
+        return
+
+    # Same kriging and nearest neighbor as interpolate_solid on the crop, only at the target cells
+    with Timer("variogram_fit"):
+        kriging = LocalKriging3D(samples['x'], samples['y'], samples['z'], samples['angle'], variogram_model="linear",
+                                 n_neighbors=kriging_neighbors, search_radius=kriging_radius)
+    target_index = tuple(targets.T)
+    with Timer("execute"):
+        krig_out[target_index] = kriging.execute("points", *targets.T.astype(float))[0]
+    with Timer("nearest_neighbor"):
+        nn_out[target_index] = samples['angle'][cKDTree(sample_points).query(targets)[1]]
+
+
+def Affected_Cells(points, changed, sample_sets, n_neighbors, block_size=8):
+    """
+    Indices of the points (n, 3) that may have a changed cell among their n_neighbors closest samples in
+    any of the sample_sets (e.g. the samples before and after the changes). A point is kept if its
+    distance to the closest changed cell is at most the distance to its n_neighbors-th closest sample.
+
+    Both distances change by at most r between a point and the center of a block of half diagonal r,
+    so blocks of block_size cells per axis are first discarded as a whole, and only the points of the
+    remaining blocks are tested.
+    """
+    changed_tree = cKDTree(changed)
+    trees = [cKDTree(samples) for samples in sample_sets if len(samples) > 0]
+
+    def reach(queries):
+        # Largest distance to the n_neighbors-th closest sample among the sample sets
+        distances = []
+        for tree in trees:
+            k = min(n_neighbors, tree.n)
+            distances.append(tree.query(queries, k=[k])[0][:, 0])
+        return np.max(distances, axis=0)
+
+    blocks, point_block = np.unique(points // block_size, axis=0, return_inverse=True)
+    centers = blocks * block_size + (block_size - 1) / 2
+    half_diagonal = np.sqrt(3) * (block_size - 1) / 2
+    candidate_blocks = changed_tree.query(centers)[0] - half_diagonal <= reach(centers) + half_diagonal
+
+    candidates = np.nonzero(candidate_blocks[point_block.ravel()])[0]
+    queries = points[candidates]
+    return candidates[changed_tree.query(queries)[0] <= reach(queries) + 1e-9]
+
+
+def _Internal_Cells(volume, cells, fluid_default):
+    # Cells whose 6 face neighbors are all solid (boundary cells are never internal, as in Remove_Internal_Solid)
+    internal = np.ones(cells[0].size, dtype=bool)
+    for axis in range(3):
+        for step in (-1, 1):
+            neighbor = list(cells)
+            neighbor[axis] = cells[axis] + step
+            inside = (neighbor[axis] >= 0) & (neighbor[axis] < volume.shape[axis])
+            internal &= inside
+            neighbor = tuple(index[inside] for index in neighbor)
+            internal[inside] &= (np.asarray(volume[neighbor]) != fluid_default)
+    return internal
+
+
+@Timed()
+def interpolate_solid_connection_surfaces_geodesic(volume, fluid_default=1, file_name="", n_closest=4, power=2, connectivity=18):
+    """
+    Interpolates the samples over the solid surface with inverse geodesic distance weighting: distances
+    are measured along paths through the surface cells, so angles do not cross fluid gaps. Each solid
+    group only receives angles from its own samples; groups without samples keep their original cells.
+    """
+    with Timer("surface_extraction"):
+        volume_surface = Remove_Internal_Solid(volume, fluid_default_value=fluid_default)
+
+    # A single graph over every surface cell: the groups are not connected to each other
+    idw_domain = Apply_Geodesic_IDW(volume_surface, fluid_default_value=fluid_default, n_closest=n_closest,
+                                    power=power, connectivity=connectivity)
+    volume_idw = limit_interpolation_to_solid(volume_surface, idw_domain, fluid_default)
+
+    if file_name != "":
+        with Timer("write"):
+            Save_Volume(file_name+"_Surface_Geodesic_idw.raw", volume_idw, fluid_default)
+
+    return volume_idw
+
+
+def _output_file_name(file_name, suffix):
+    return file_name + suffix if file_name != "" else ""
+
+def _output_volume(out, file_name, volume, fluid_default, initialize=True):
+    # Output array of a pipeline: out if given, else a memory map on file_name (if given), else a new
+    # array. If initialize, it starts as a copy of volume, written slab by slab
+    if out is None and file_name != "":
+        out, _ = Create_Volume(file_name, volume.shape, np.uint8, fluid_default_value=fluid_default)
+    elif out is None:
+        out = np.empty(volume.shape, dtype=np.uint8)
+    if initialize:
+        for planes in Volume_Slabs(volume.shape):
+            out[planes] = volume[planes]
+    return out
+
 
-    final_domain = volume.copy()
-    for index in np.ndindex(volume.shape):
-        # If is solid: final = interpolated
-        if volume[index] != fluid_default_value:
-            final_domain[index] = interpolated_domain[index]
+def limit_interpolation_to_solid(volume, interpolated_domain, fluid_default_value, out=None):
+    """
+    Writes the interpolated values on the solid cells of out, in a single masked assignment.
+    If out is not given, it is an unsigned char copy of volume (fluid cells keep the volume value).
+    """
+    if out is None:
+        out = volume.astype(np.uint8)
 
-    return final_domain
+    # If is solid: final = interpolated
+    solid = (volume != fluid_default_value)
+    out[solid] = interpolated_domain[solid]
 
+    return out
 
+
+@Timed()
 def Apply_Kriging(df, n_points=5, tested_methods=["linear", "power", "gaussian", "spherical", "exponential", "hole-effect"],
-                  x_lim=(0, 250), y_lim=(0, 250), z_lim=(0, 250)):
+                  x_lim=(0, 250), y_lim=(0, 250), z_lim=(0, 250), target_mask=None, n_neighbors=None, search_radius=None,
+                  n_workers=1, tile_size=32, return_scores=False):
+    """
+    Interpolates the sample angles with Universal Kriging over the grid defined by x_lim, y_lim and z_lim.
+    The samples (df) are a DataFrame or a dictionary of arrays (Extract_Samples) with x, y, z and angle.
+
+    If target_mask (boolean array with the grid shape) is given, only the cells where it is True are
+    kriged, as a list of points, and the remaining cells of the returned grid are NaN.
+
+    If n_neighbors is given, local kriging (LocalKriging3D) is used instead: each cell is kriged with
+    its n_neighbors closest samples only, optionally limited to search_radius.
+
+    If n_workers > 1, the target cells are split into tiles of tile_size cells per axis that are kriged
+    concurrently by n_workers processes.
+
+    If several tested_methods are given, the variogram model is chosen by leave-one-out cross-validation
+    on the samples, and only the chosen model is executed on the grid. With return_scores=True, the
+    mean squared leave-one-out residual of each model is also returned.
+    """
     print("-Applying Kriging: ")
     
     # Coleta o sub domínio em analise
@@ -126,10 +468,10 @@ def Apply_Kriging(df, n_points=5, tested_methods=["linear", "power", "gaussian",
     z_min, z_max = z_lim
 
     # Coletar as coordenadas e o ângulo
-    x = df['x'].values
-    y = df['y'].values
-    z = df['z'].values
-    angle = df['angle'].values
+    x = np.asarray(df['x'])
+    y = np.asarray(df['y'])
+    z = np.asarray(df['z'])
+    angle = np.asarray(df['angle'])
 
     # Definindo a grade de pontos para a interpolação (menos pontos para otimizar memória)
     gridx = np.arange(x_min, x_max, 1)
@@ -149,97 +491,277 @@ def Apply_Kriging(df, n_points=5, tested_methods=["linear", "power", "gaussian",
     if np.all(angle == angle[0]):
         print(f"--All samples provided have the exact same value ({angle[0]}), kriging was not necessary. The single value was propagated.")
         # Criar o array 3D preenchido com angle[0]
-        return np.full((x_dim, y_dim, z_dim), angle[0])
+        prediction = np.full((x_dim, y_dim, z_dim), angle[0])
+        return (prediction, {}) if return_scores else prediction
     elif angle.size <= 2:
         print("--Only 2 samples were provided, kriging is not applicable. Mean values was propagated.")
         # Criar o array 3D preenchido com angle[0]
-        return np.full((x_dim, y_dim, z_dim), (angle[0]+angle[1])/2) 
+        prediction = np.full((x_dim, y_dim, z_dim), (angle[0]+angle[1])/2)
+        return (prediction, {}) if return_scores else prediction
     else:
         
-        # Criar o modelo de krigagem com variogram model (Ex: exponencial)
-        # Definindo o modelo de variograma, neste caso exponencial (exponential)
-
-        best_residual = float('inf')
-        best_prediction = None
-
-        for method in tested_methods:
-            print("--Universal Kriging, method: ", method)
-            ok3d = UniversalKriging3D(x, y, z, angle, variogram_model=method, enable_plotting=True)
-
-            # A matriz de kriging de cada ponto do grid tem N = (n_samples+1)**2 elementos,
-            # O método vetorizado utiliza a inversao da matriz, demandando 32*N**2 bytes.
-            # O metodo loop evita a inversao de matriz, executando cada ponto do grid em loop
-
-            predictions_3D, residual_variances = ok3d.execute(
-                style="grid",
-                backend='loop',
-                xpoints=gridx,
-                ypoints=gridy,
-                zpoints=gridz)
+        # Selecao do modelo de variograma por validacao cruzada (leave-one-out) apenas nas amostras,
+        # sem estimar o grid para cada modelo
+        selection_scores = {}
+        best_method = tested_methods[0]
+        if len(tested_methods) > 1:
+            with Timer("variogram_selection"):
+                for method in tested_methods:
+                    selection_scores[method] = Cross_Validate_Variogram(x, y, z, angle, method, n_neighbors=n_neighbors, search_radius=search_radius)
+                    print("--Variogram model: ", method, ", leave-one-out mean squared error: ", round(selection_scores[method], 2))
+            best_method = min(tested_methods, key=lambda method: selection_scores[method])
+            print("New best solution found: variogram model ", best_method)
+
+        # Criar o modelo de krigagem com o melhor modelo de variograma
+        with Timer("variogram_fit"):
+            if n_neighbors is None:
+                print("--Universal Kriging, method: ", best_method)
+                ok3d = UniversalKriging3D(x, y, z, angle, variogram_model=best_method, enable_plotting=True)
+            else:
+                print("--Local Kriging, method: ", best_method, ", neighbors: ", n_neighbors)
+                ok3d = LocalKriging3D(x, y, z, angle, variogram_model=best_method, n_neighbors=n_neighbors, search_radius=search_radius)
+
+        # A matriz de kriging de cada ponto do grid tem N = (n_samples+1)**2 elementos,
+        # O método vetorizado utiliza a inversao da matriz, demandando 32*N**2 bytes.
+        # O metodo loop evita a inversao de matriz, executando cada ponto do grid em loop
+
+        if target_mask is None and n_workers <= 1:
+            Count("kriging_systems", x_dim * y_dim * z_dim)
+            with Timer("execute"):
+                predictions_3D, residual_variances = ok3d.execute(
+                    style="grid",
+                    backend='loop',
+                    xpoints=gridx,
+                    ypoints=gridy,
+                    zpoints=gridz)
 
             predictions_3D = predictions_3D.transpose( 2, 1, 0)  # Ajuste de [z, y, x] para [x, y, z]
-            
-            statistical_maximum_residual = np.mean(residual_variances)+2*np.std(residual_variances)
-            if  statistical_maximum_residual < best_residual:
-                print("New best solution found: statistical maximum residual: ", round(statistical_maximum_residual,2))
-                best_prediction = predictions_3D
-            
-        return best_prediction
-
+        else:
+            # Apenas as celulas alvo sao estimadas, e depois espalhadas de volta no grid
+            if target_mask is None:
+                target_mask = np.ones((x_dim, y_dim, z_dim), dtype=bool)
+            target_index = np.nonzero(target_mask)
+            target_points = (gridx[target_index[0]], gridy[target_index[1]], gridz[target_index[2]])
+            Count("kriging_targets", target_index[0].size)
+            Count("kriging_systems", target_index[0].size)
+
+            with Timer("execute"):
+                if n_workers > 1:
+                    predictions, residual_variances = Execute_Kriging_Tiles(
+                        ok3d,
+                        np.column_stack(target_points),
+                        np.column_stack(target_index),
+                        tile_size=tile_size,
+                        n_workers=n_workers)
+                else:
+                    predictions, residual_variances = ok3d.execute(
+                        style="points",
+                        backend='loop',
+                        xpoints=target_points[0],
+                        ypoints=target_points[1],
+                        zpoints=target_points[2])
+
+            predictions_3D = np.full((x_dim, y_dim, z_dim), np.nan)
+            predictions_3D[target_index] = predictions
+
+        return (predictions_3D, selection_scores) if return_scores else predictions_3D
+
+
+@Timed()
+def Build_Kriging_Operator(df, target_mask, variogram_model="linear", variogram_parameters=None, n_neighbors=None, search_radius=None,
+                           x_lim=(0, 250), y_lim=(0, 250), z_lim=(0, 250)):
+    """
+    Computes once the kriging weights from the samples in df to the cells of target_mask, so that other
+    angle sets at the same sample cells (e.g. wettability scenarios) are kriged with Apply_Kriging_Operator.
+    The variogram is given by variogram_parameters or fitted from the angles in df.
+    """
+    print("-Building Kriging operator: ")
+    target_index = np.nonzero(target_mask)
+    target_points = np.column_stack((target_index[0] + x_lim[0], target_index[1] + y_lim[0], target_index[2] + z_lim[0]))
+
+    operator = KrigingOperator(np.asarray(df['x']), np.asarray(df['y']), np.asarray(df['z']), target_points,
+                               variogram_model=variogram_model, variogram_parameters=variogram_parameters,
+                               values=np.asarray(df['angle']), n_neighbors=n_neighbors, search_radius=search_radius)
+    operator.target_index = target_index
+    operator.grid_shape = (x_lim[1] - x_lim[0], y_lim[1] - y_lim[0], z_lim[1] - z_lim[0])
+    return operator
+
+
+def Apply_Kriging_Operator(operator, angles):
+    """
+    Kriges angle sets with an operator from Build_Kriging_Operator. angles has one row per sample (in the
+    order of the df used to build it) and, optionally, one column per set. Returns the grid (with a last
+    axis per set), with NaN outside the target cells.
+    """
+    angles = np.asarray(angles, dtype=float)
+    predictions = operator.apply(angles)
+
+    predictions_3D = np.full(operator.grid_shape + angles.shape[1:], np.nan)
+    predictions_3D[operator.target_index] = predictions
+    return predictions_3D
+
+
+@Timed()
+def Filtra_KNN(df_medidas, K=5, mode="mean", radius=None, power=2, chunk_size=2**16):
+    """
+    Smooths the sample angles with their K nearest samples (the sample itself included), computed for
+    all samples at once from the KD-tree neighbor indices.
+
+    Parameters:
+        df_medidas: DataFrame or dictionary of arrays with x, y, z and angle.
+        K (int): Number of nearest samples (including the sample itself).
+        mode (str): "mean", "median" or "idw" (inverse distance weighting, 1/d**power, with d at least
+                    one cell so that the sample weighs as a neighbor at one cell).
+        radius (float): If given, neighbors farther than radius are not used (the sample itself always is).
+        chunk_size (int): Samples filtered at once, limiting the memory of the neighbor arrays.
+
+    Returns:
+        Copy of df_medidas (same type) with the filtered angles.
+    """
+    if mode not in ("mean", "median", "idw"):
+        raise ValueError("Invalid mode: choose 'mean', 'median' or 'idw'")
 
-def Filtra_KNN(df_medidas, K=5):
     # Parâmetro K (número de vizinhos mais próximos)
-    coords = df_medidas[['x', 'y', 'z']].values
-    # Aplicando o modelo de K-vizinhos mais próximos
-    knn = NearestNeighbors(n_neighbors=K)
-    knn.fit(coords)
-    distances, indices = knn.kneighbors(coords)
-
-    # Calculando a média ou mediana dos ângulos dos K vizinhos mais próximos
-    angulo_filtrado_knn = []
-    for i in range(len(df_medidas)):
-        centroid_grupo = indices[i]
-        # Usando média, pode ser mediana
-        angulo_filtrado_knn.append(
-            df_medidas.iloc[centroid_grupo]['angle'].mean())
-
-    df_filtered = df_medidas.copy()
+    coords = np.column_stack((df_medidas['x'], df_medidas['y'], df_medidas['z'])).astype(float)
+    angle = np.asarray(df_medidas['angle'], dtype=float)
+    K = min(K, angle.size)
+    tree = cKDTree(coords)
+
+    # Missing neighbors (outside the radius) get the index angle.size: NaN angle and no weight
+    padded_angle = np.append(angle, np.nan)
+    angulo_filtrado_knn = np.empty(angle.size)
+    for start in range(0, angle.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        distances, indices = tree.query(coords[chunk], k=K, distance_upper_bound=np.inf if radius is None else radius, workers=-1)
+        distances, indices = distances.reshape(-1, K), indices.reshape(-1, K)
+        neighbor_angles = padded_angle[indices]
+        used = indices < angle.size
+
+        if mode == "mean":
+            angulo_filtrado_knn[chunk] = np.sum(np.where(used, neighbor_angles, 0.0), axis=1) / np.sum(used, axis=1)
+        elif mode == "median":
+            angulo_filtrado_knn[chunk] = neighbor_angles[:, 0] if K == 1 else np.nanmedian(neighbor_angles, axis=1)
+        else:
+            weights = np.where(used, 1.0 / np.maximum(distances, 1.0) ** power, 0.0)
+            angulo_filtrado_knn[chunk] = np.sum(weights * np.where(used, neighbor_angles, 0.0), axis=1) / np.sum(weights, axis=1)
+
+    if isinstance(df_medidas, dict):
+        df_filtered = dict(df_medidas)
+    else:
+        df_filtered = df_medidas.copy()
     df_filtered['angle'] = angulo_filtrado_knn
 
     return df_filtered
 
 
-def Apply_NearestNeighbor(sub_df, n_neighbors=1, x_lim=(0, 250), y_lim=(0, 250), z_lim=(0, 250)):
+@Timed()
+def Apply_NearestNeighbor(sub_df, n_neighbors=1, x_lim=(0, 250), y_lim=(0, 250), z_lim=(0, 250), target_mask=None, chunk_size=2**20):
+    """
+    Assigns to each cell of the grid (x_lim, y_lim, z_lim) the angle of the nearest sample (sub_df is a
+    DataFrame or a dictionary of arrays with x, y, z and angle).
+
+    On the full grid, with every sample on a grid cell, the nearest sample of every cell comes from a
+    Euclidean distance transform returning feature indices. Otherwise (samples between cells or outside
+    the grid), or if target_mask is given, the cells (only those of target_mask, NaN elsewhere) query a
+    KD-tree of the samples in chunks of chunk_size cells. Only the nearest neighbor is used.
+    """
     print("-Applying Nearest Neighbor:")
-    # Nearest Neighbor model
-    x = sub_df['x'].values
-    y = sub_df['y'].values
-    z = sub_df['z'].values
-    angle = sub_df['angle'].values
-    coords = np.vstack([x, y, z]).T  # Combine sampled coordinates
-    nn = NearestNeighbors(n_neighbors=n_neighbors)  # Configure the model
-    nn.fit(coords)  # Fit the model to the sampled coordinates
+    angle = np.asarray(sub_df['angle'])
 
     # Coleta o sub domínio em analise
     x_min, x_max = x_lim
     y_min, y_max = y_lim
     z_min, z_max = z_lim
-
-    gridx = np.arange(x_min, x_max, 1)
-    gridy = np.arange(y_min, y_max, 1)
-    gridz = np.arange(z_min, z_max, 1)
-
-    # Create the interpolation grid
-    x_grid, y_grid, z_grid = np.meshgrid(gridx, gridy, gridz, indexing='ij')
-    # Flatten grid to [x, y, z] points
-    grid_points = np.vstack([x_grid.ravel(), y_grid.ravel(), z_grid.ravel()]).T
-    # Find the nearest neighbors and their indices
-    distances, indices = nn.kneighbors(grid_points)
-    # Assign the corresponding values to the grid points
-    # Use the nearest neighbor's value
-    interpolated_values = angle[indices[:, 0]]
-    # Reshape the interpolated values to match the 3D grid shape
-    interpolated_grid = interpolated_values.reshape(x_grid.shape)
-
-    
-    return interpolated_grid
\ No newline at end of file
+    grid_shape = (x_max - x_min, y_max - y_min, z_max - z_min)
+
+    # Sample coordinates relative to the grid
+    sample_points = np.column_stack((np.asarray(sub_df['x']) - x_min,
+                                     np.asarray(sub_df['y']) - y_min,
+                                     np.asarray(sub_df['z']) - z_min)).astype(float)
+    sample_index = tuple(np.rint(sample_points).astype(np.intp).T)
+    on_grid = np.array_equal(np.column_stack(sample_index), sample_points) and \
+              all(np.all((index >= 0) & (index < size)) for index, size in zip(sample_index, grid_shape))
+
+    # The distance transform needs the samples on grid cells: otherwise the KD-tree is used on every cell
+    if target_mask is None and not on_grid:
+        target_mask = np.ones(grid_shape, dtype=bool)
+
+    if target_mask is None:
+        # Each cell receives the indices of its closest sample cell (zero in the input)
+        sample_angles = np.zeros(grid_shape)
+        sample_angles[sample_index] = angle
+        not_sample = np.ones(grid_shape, dtype=bool)
+        not_sample[sample_index] = False
+        nearest_index = distance_transform_edt(not_sample, return_distances=False, return_indices=True)
+        interpolated_grid = sample_angles[tuple(nearest_index)]
+    else:
+        tree = cKDTree(sample_points)
+        target_index = np.nonzero(target_mask)
+        interpolated_values = np.empty(target_index[0].size)
+        for start in range(0, interpolated_values.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            # Find the nearest sample and use its value
+            _, indices = tree.query(np.column_stack([axis[chunk] for axis in target_index]))
+            interpolated_values[chunk] = angle[indices]
+
+        interpolated_grid = np.full(grid_shape, np.nan)
+        interpolated_grid[target_index] = interpolated_values
+        Count("nearest_neighbor_targets", target_index[0].size)
+
+    return interpolated_grid
+
+
+@Timed()
+def Apply_Geodesic_IDW(volume, fluid_default_value=1, n_closest=4, power=2, connectivity=18, max_distance=np.inf):
+    """
+    Inverse geodesic distance weighting of the sample cells of volume over its non-fluid cells.
+
+    The geodesic distances are shortest paths on the graph of non-fluid cells (Dijkstra3D.solid_graph).
+    The n_closest samples of every cell (optionally within max_distance) come from a single multi-source
+    pass: a compiled Dijkstra with n_closest=1, or Dijkstra3D.k_nearest_sources otherwise.
+
+    Paths stay inside the solid groups of Label_NonFluid_Connections (18-connectivity): with
+    connectivity=26, the edges between groups touching only at a corner are removed.
+
+    Returns:
+        np.ndarray: Interpolated values on the non-fluid cells reached by a sample, volume values elsewhere.
+    """
+    print("-Applying Geodesic Inverse Distance Weighting:")
+    graph, node_index, node_coords = Dijkstra3D.solid_graph(volume, connectivity=connectivity, fluid_default_value=fluid_default_value)
+    if connectivity == 26:
+        node_labels = Label_NonFluid_Connections(volume, fluid_default_value)[0][tuple(node_coords.T)]
+        edges = graph.tocoo()
+        same_group = node_labels[edges.row] == node_labels[edges.col]
+        graph = csr_matrix((edges.data[same_group], (edges.row[same_group], edges.col[same_group])), shape=graph.shape)
+
+    sample_cells = np.nonzero((volume != fluid_default_value) & (volume != 0) & (volume != 1))
+    sample_nodes = node_index[sample_cells]
+    angle = volume[sample_cells].astype(float)
+    if angle.size == 0: raise ValueError("No sample cells. Make sure to provide samples for interpolation")
+
+    n_nodes = len(node_coords)
+    n_closest = min(n_closest, angle.size)
+    if n_closest == 1:
+        distances, _, closest_nodes = Dijkstra3D.shortest_paths(graph, sample_nodes, min_only=True, limit=max_distance)
+        sample_of_node = np.full(n_nodes, -1)
+        sample_of_node[sample_nodes] = np.arange(angle.size)
+        closest_distances = distances[:, np.newaxis]
+        closest_samples = np.where(closest_nodes >= 0, sample_of_node[np.maximum(closest_nodes, 0)], -1)[:, np.newaxis]
+    else:
+        closest_distances, closest_samples = Dijkstra3D.k_nearest_sources(graph, sample_nodes, n_closest, limit=max_distance)
+
+    # Inverse distance weights; a sample cell keeps its own value
+    reached = np.isfinite(closest_distances)
+    with np.errstate(divide='ignore'):
+        weights = np.where(reached, 1.0 / closest_distances ** power, 0.0)
+    at_sample = closest_distances == 0
+    weights[np.any(at_sample, axis=1)] = 0.0
+    weights[at_sample] = 1.0
+
+    total_weight = weights.sum(axis=1)
+    reached_nodes = total_weight > 0
+    values = np.sum(weights * angle[np.maximum(closest_samples, 0)], axis=1)
+
+    interpolated_grid = volume.astype(float)
+    interpolated_grid[tuple(node_coords[reached_nodes].T)] = values[reached_nodes] / total_weight[reached_nodes]
+    return interpolated_grid
@@ -0,0 +1,454 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
+from scipy.linalg import lu_factor, lu_solve
+from pykrige.uk3d import UniversalKriging3D
+from pykrige.core import _initialize_variogram_model, _make_variogram_parameter_list, _adjust_for_anisotropy
+from Parallel_Utilities import Create_Shared_Array, Attach_Shared_Array, Release_Shared_Arrays
+from concurrent.futures import ProcessPoolExecutor
+
+
+class LocalKriging3D:
+    """
+    Ordinary kriging in a moving neighborhood for 3D grids.
+
+    Each target point is kriged only with its n_neighbors closest samples (optionally limited to a
+    search radius), found with a KD-tree. The small kriging systems are solved in batches, so the
+    cost grows linearly with the number of targets instead of with the number of samples squared.
+    The interface follows pykrige's UniversalKriging3D (variogram_model_parameters, execute).
+    """
+
+    variogram_dict = UniversalKriging3D.variogram_dict
+
+    def __init__(self, x, y, z, values, variogram_model="linear", variogram_parameters=None,
+                 n_neighbors=16, search_radius=None, nlags=6, max_fit_samples=2000, random_state=0):
+        """
+        Args:
+            x, y, z (np.ndarray): Coordinates of the samples.
+            values (np.ndarray): Values of the samples.
+            variogram_model (str): One of the pykrige variogram models.
+            variogram_parameters (list or dict): Fixed variogram parameters (pykrige format).
+                                                 If None, they are fitted from the samples.
+            n_neighbors (int): Maximum number of samples used to krige each target.
+            search_radius (float): If given, samples farther than this are not used (the closest
+                                   sample is always used).
+            nlags (int): Number of lags of the experimental variogram.
+            max_fit_samples (int): The variogram is fitted on a random subset of at most this many
+                                   samples, since the fit needs every pair of samples.
+            random_state (int): Seed of the subset used in the variogram fit.
+        """
+        if variogram_model not in self.variogram_dict:
+            raise ValueError("Specified variogram model '%s' is not supported." % variogram_model)
+
+        self.samples = np.column_stack((x, y, z)).astype(float)
+        self.values = np.asarray(values, dtype=float)
+        self.variogram_model = variogram_model
+        self.variogram_function = self.variogram_dict[variogram_model]
+        self.n_neighbors = min(n_neighbors, self.values.size)
+        self.search_radius = search_radius
+        self.tree = cKDTree(self.samples)
+
+        self.lags, self.semivariance, self.variogram_model_parameters = Fit_Variogram(
+            self.samples, self.values, variogram_model, variogram_parameters, nlags, max_fit_samples, random_state)
+
+    def execute(self, style, xpoints, ypoints, zpoints, backend=None, batch_size=4096):
+        """
+        Kriges the given points, as pykrige's execute.
+
+        Args:
+            style (str): "grid" (xpoints, ypoints and zpoints are the grid axes) or "points".
+            xpoints, ypoints, zpoints (np.ndarray): Target coordinates.
+            backend: Ignored, kept for call compatibility with pykrige.
+            batch_size (int): Number of kriging systems solved at once.
+
+        Returns:
+            tuple: Predictions and kriging variances. In "grid" style, with shape [z, y, x].
+        """
+        xpoints = np.atleast_1d(np.asarray(xpoints, dtype=float))
+        ypoints = np.atleast_1d(np.asarray(ypoints, dtype=float))
+        zpoints = np.atleast_1d(np.asarray(zpoints, dtype=float))
+
+        if style == "grid":
+            grid_z, grid_y, grid_x = np.meshgrid(zpoints, ypoints, xpoints, indexing="ij")
+            points = np.column_stack((grid_x.ravel(), grid_y.ravel(), grid_z.ravel()))
+            output_shape = grid_x.shape
+        elif style == "points":
+            if not (xpoints.size == ypoints.size == zpoints.size):
+                raise ValueError("xpoints, ypoints and zpoints must have the same size with style='points'")
+            points = np.column_stack((xpoints, ypoints, zpoints))
+            output_shape = xpoints.shape
+        else:
+            raise ValueError("style argument must be 'grid' or 'points'")
+
+        predictions = np.empty(len(points))
+        variances = np.empty(len(points))
+        for start in range(0, len(points), batch_size):
+            batch = slice(start, start + batch_size)
+            predictions[batch], variances[batch] = self._krige_batch(points[batch])
+
+        return predictions.reshape(output_shape), variances.reshape(output_shape)
+
+    def neighborhoods(self, points, exclude_self=False):
+        """
+        Finds the samples used to krige each point.
+
+        Returns:
+            tuple: Distances and sample indices, shape (n_points, n_neighbors), and a boolean mask
+                   of the neighbors actually used (False outside the search radius).
+        """
+        k = self.n_neighbors + 1 if exclude_self else self.n_neighbors
+        k = min(k, self.values.size)
+        distances, indices = self.tree.query(points, k=k)
+        distances = distances.reshape(len(points), k)
+        indices = indices.reshape(len(points), k)
+        if exclude_self:
+            # The first neighbor of a sample is itself
+            distances, indices = distances[:, 1:], indices[:, 1:]
+
+        used = np.ones(distances.shape, dtype=bool)
+        if self.search_radius is not None:
+            used = distances <= self.search_radius
+            used[:, 0] = True
+        return distances, indices, used
+
+    def kriging_weights(self, points, exclude_self=False):
+        """
+        Solves the kriging systems of the given points.
+
+        Returns:
+            tuple: Weights and sample indices, shape (n_points, n_neighbors), and kriging variances.
+        """
+        distances, indices, used = self.neighborhoods(points, exclude_self)
+        n_points, k = indices.shape
+
+        # Kriging matrix with the pykrige conventions: -gamma between samples, zero diagonal,
+        # and the unbiasedness row/column
+        neighbors = self.samples[indices]
+        pair_distances = np.linalg.norm(neighbors[:, :, np.newaxis, :] - neighbors[:, np.newaxis, :, :], axis=-1)
+        a = np.zeros((n_points, k + 1, k + 1))
+        a[:, :k, :k] = -self.variogram_function(self.variogram_model_parameters, pair_distances)
+        diagonal = np.arange(k)
+        a[:, diagonal, diagonal] = 0.0
+        a[:, k, :k] = 1.0
+        a[:, :k, k] = 1.0
+
+        b = np.zeros((n_points, k + 1))
+        b[:, :k] = -self.variogram_function(self.variogram_model_parameters, distances)
+        b[:, :k][distances <= 1e-10] = 0.0  # Exact interpolation at the samples
+        b[:, k] = 1.0
+
+        # Neighbors outside the search radius get a decoupled equation with weight zero
+        unused = ~used
+        if np.any(unused):
+            a[:, :k, :k][unused] = 0.0
+            a[:, :k, :k].transpose(0, 2, 1)[unused] = 0.0
+            a[:, :k, k][unused] = 0.0
+            a[:, k, :k][unused] = 0.0
+            a[:, diagonal, diagonal] += unused
+            b[:, :k][unused] = 0.0
+
+        x = np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+        variances = np.sum(x * -b, axis=1)
+        return x[:, :k], indices, variances
+
+    def leave_one_out(self, batch_size=4096):
+        """
+        Kriges each sample from its neighbors, without the sample itself.
+
+        Returns:
+            np.ndarray: Leave-one-out predictions of the samples.
+        """
+        predictions = np.empty(self.values.size)
+        for start in range(0, self.values.size, batch_size):
+            batch = slice(start, start + batch_size)
+            weights, indices, _ = self.kriging_weights(self.samples[batch], exclude_self=True)
+            predictions[batch] = np.sum(weights * self.values[indices], axis=1)
+        return predictions
+
+    def _krige_batch(self, points):
+        weights, indices, variances = self.kriging_weights(points)
+        predictions = np.sum(weights * self.values[indices], axis=1)
+        return predictions, variances
+
+
+def Fit_Variogram(samples, values, variogram_model, variogram_parameters=None, nlags=6, max_fit_samples=2000, random_state=0):
+    """
+    Fits a pykrige variogram model to the samples, as UniversalKriging3D does.
+
+    Args:
+        samples (np.ndarray): Sample coordinates, shape (n, 3).
+        values (np.ndarray): Sample values.
+        variogram_model (str): One of the pykrige variogram models.
+        variogram_parameters (list or dict): Fixed parameters. If given, they are only validated.
+        nlags (int): Number of lags of the experimental variogram.
+        max_fit_samples (int): The fit uses a random subset of at most this many samples (None for all).
+        random_state (int): Seed of the subset.
+
+    Returns:
+        tuple: Lags, semivariances and variogram model parameters.
+    """
+    fit_index = np.arange(len(values))
+    if max_fit_samples is not None and fit_index.size > max_fit_samples:
+        rng = np.random.default_rng(random_state)
+        fit_index = np.sort(rng.choice(fit_index, size=max_fit_samples, replace=False))
+    return _initialize_variogram_model(
+        np.asarray(samples, dtype=float)[fit_index],
+        np.asarray(values, dtype=float)[fit_index],
+        variogram_model,
+        _make_variogram_parameter_list(variogram_model, variogram_parameters),
+        UniversalKriging3D.variogram_dict[variogram_model],
+        nlags,
+        False,
+        "euclidean")
+
+
+def _variogram_parameters_dict(variogram_model, variogram_model_parameters):
+    # Fitted parameters in the dict format accepted back by pykrige (a list would be read as full sill)
+    names = {"linear": ["slope", "nugget"], "power": ["scale", "exponent", "nugget"]}.get(variogram_model, ["psill", "range", "nugget"])
+    return dict(zip(names, [float(parameter) for parameter in variogram_model_parameters]))
+
+
+def Cross_Validate_Variogram(x, y, z, values, variogram_model, n_neighbors=None, search_radius=None):
+    """
+    Leave-one-out cross-validation of a variogram model, using the samples only.
+
+    With a global neighborhood (n_neighbors=None), the residuals of all samples come from a single
+    inversion of the kriging matrix (Dubrule, 1983). With a local neighborhood, each sample is kriged
+    from its n_neighbors closest other samples.
+
+    Returns:
+        float: Mean squared leave-one-out residual.
+    """
+    values = np.asarray(values, dtype=float)
+    samples = np.column_stack((x, y, z)).astype(float)
+
+    if n_neighbors is not None:
+        kriging = LocalKriging3D(x, y, z, values, variogram_model=variogram_model,
+                                 n_neighbors=n_neighbors, search_radius=search_radius)
+        residuals = values - kriging.leave_one_out()
+    else:
+        _, _, parameters = Fit_Variogram(samples, values, variogram_model, max_fit_samples=None)
+        variogram_function = UniversalKriging3D.variogram_dict[variogram_model]
+
+        # Ordinary kriging matrix of every sample, with the unbiasedness row/column
+        n = values.size
+        a = np.zeros((n + 1, n + 1))
+        a[:n, :n] = variogram_function(parameters, cdist(samples, samples))
+        np.fill_diagonal(a, 0.0)
+        a[n, :n] = 1.0
+        a[:n, n] = 1.0
+
+        a_inv = np.linalg.pinv(a)
+        residuals = (a_inv[:n, :n] @ values) / np.diag(a_inv)[:n]
+
+    score = float(np.mean(residuals ** 2))
+    return score if np.isfinite(score) else float('inf')
+
+
+class GlobalKrigingSystem:
+    """
+    Ordinary kriging system with every sample as neighbor (as UniversalKriging3D without drift),
+    factorized once: the weights of any targets are then solved without building or inverting the
+    kriging matrix again.
+    """
+
+    def __init__(self, samples, variogram_model, variogram_model_parameters):
+        self.samples = np.asarray(samples, dtype=float)
+        self.variogram_model = variogram_model
+        self.variogram_model_parameters = variogram_model_parameters
+
+        n_samples = len(self.samples)
+        a = np.zeros((n_samples + 1, n_samples + 1))
+        a[:n_samples, :n_samples] = -self._variogram(cdist(self.samples, self.samples))
+        np.fill_diagonal(a, 0.0)
+        a[n_samples, :n_samples] = 1.0
+        a[:n_samples, n_samples] = 1.0
+        self.factorization = lu_factor(a)
+
+    def _variogram(self, distances):
+        return UniversalKriging3D.variogram_dict[self.variogram_model](self.variogram_model_parameters, distances)
+
+    def solve(self, points):
+        """
+        Returns:
+            tuple: Kriging weights of the targets, shape (n_points, n_samples), and their kriging variances.
+        """
+        n_samples = len(self.samples)
+        distances = cdist(points, self.samples)
+        b = np.ones((n_samples + 1, len(distances)))
+        b[:n_samples] = -self._variogram(distances).T
+        b[:n_samples][distances.T <= 1e-10] = 0.0  # Exact interpolation at the samples
+        x_solution = lu_solve(self.factorization, b)
+        weights, variances = x_solution[:n_samples].T, np.sum(x_solution * -b, axis=0)
+
+        # As pykrige (exact_values), a target on a sample takes exactly its value
+        on_sample, sample = np.nonzero(distances <= 1e-10)
+        weights[on_sample] = 0.0
+        weights[on_sample, sample] = 1.0
+        variances[on_sample] = 0.0
+        return weights, variances
+
+
+class KrigingOperator:
+    """
+    Kriging weights of a fixed sample layout and target set, reusable for many value sets.
+
+    The weights depend only on the sample positions and the variogram, so they are computed once and
+    each new set of sample values is kriged with a single matrix product. The weight matrix is sparse
+    (scipy CSR) with a local neighborhood and dense with the global one.
+    """
+
+    def __init__(self, x, y, z, points, variogram_model="linear", variogram_parameters=None, values=None,
+                 n_neighbors=None, search_radius=None, batch_size=4096):
+        """
+        Args:
+            x, y, z (np.ndarray): Coordinates of the samples.
+            points (np.ndarray): Target coordinates, shape (n_points, 3).
+            variogram_model (str): One of the pykrige variogram models.
+            variogram_parameters (list or dict): Variogram parameters (pykrige format). If None, they are
+                                                 fitted from values.
+            values (np.ndarray): Reference sample values, used only to fit the variogram.
+            n_neighbors (int): If given, local neighborhood of LocalKriging3D (sparse weights).
+            search_radius (float): Search radius of the local neighborhood.
+            batch_size (int): Number of targets whose weights are computed at once.
+        """
+        if variogram_parameters is None and values is None:
+            raise ValueError("Provide variogram_parameters or reference values to fit the variogram")
+
+        samples = np.column_stack((x, y, z)).astype(float)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n_samples, n_points = len(samples), len(points)
+        if values is None:
+            values = np.zeros(n_samples)
+
+        self.variogram_model = variogram_model
+        # Same fit as the kriging engines: every sample for the global one, a bounded subset for the local one
+        max_fit_samples = None if n_neighbors is None else 2000
+        _, _, self.variogram_model_parameters = Fit_Variogram(samples, values, variogram_model, variogram_parameters,
+                                                              max_fit_samples=max_fit_samples)
+        self.variances = np.empty(n_points)
+
+        if n_neighbors is not None:
+            kriging = LocalKriging3D(x, y, z, values, variogram_model=variogram_model,
+                                     variogram_parameters=_variogram_parameters_dict(variogram_model, self.variogram_model_parameters),
+                                     n_neighbors=n_neighbors, search_radius=search_radius)
+            rows, cols, data = [], [], []
+            for start in range(0, n_points, batch_size):
+                batch = slice(start, start + batch_size)
+                weights, indices, self.variances[batch] = kriging.kriging_weights(points[batch])
+                rows.append(np.repeat(np.arange(start, start + len(weights)), weights.shape[1]))
+                cols.append(indices.ravel())
+                data.append(weights.ravel())
+            self.weights = csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                      shape=(n_points, n_samples))
+        else:
+            # The global kriging matrix is factorized once for every target
+            system = GlobalKrigingSystem(samples, variogram_model, self.variogram_model_parameters)
+            self.weights = np.empty((n_points, n_samples))
+            for start in range(0, n_points, batch_size):
+                batch = slice(start, start + batch_size)
+                self.weights[batch], self.variances[batch] = system.solve(points[batch])
+
+    def apply(self, values):
+        """
+        Kriges one or many sets of sample values.
+
+        Args:
+            values (np.ndarray): Sample values, shape (n_samples,) or (n_samples, n_sets).
+
+        Returns:
+            np.ndarray: Predictions at the targets, shape (n_points,) or (n_points, n_sets).
+        """
+        return self.weights @ np.asarray(values, dtype=float)
+
+
+def Execute_Kriging_Tiles(kriging, points, grid_index, tile_size=32, n_workers=2, backend="loop"):
+    """
+    Kriges a list of points in parallel, splitting them into spatial tiles that are kriged concurrently
+    by worker processes. The fitted kriging object (variogram and samples) is sent once to each worker,
+    and each tile writes its results directly into preallocated shared outputs. For global kriging
+    (UniversalKriging3D without drift) the kriging matrix is factorized once (GlobalKrigingSystem) and
+    the workers only solve the targets of their tiles.
+
+    Args:
+        kriging: Fitted UniversalKriging3D or LocalKriging3D.
+        points (np.ndarray): Target coordinates, shape (n, 3).
+        grid_index (np.ndarray): Integer grid index of each target, shape (n, 3), used to build the tiles.
+        tile_size (int): Edge of the cubic tiles, in cells.
+        n_workers (int): Number of worker processes.
+        backend (str): pykrige backend used by the workers.
+
+    Returns:
+        tuple: Predictions and kriging variances of the points, in the input order.
+    """
+    n_points = len(points)
+
+    system = None
+    if isinstance(kriging, UniversalKriging3D) and not (kriging.regional_linear_drift or kriging.specified_drift or kriging.functional_drift):
+        # Same coordinates as UniversalKriging3D.execute: samples and targets adjusted for anisotropy
+        system = GlobalKrigingSystem(np.column_stack((kriging.X_ADJUSTED, kriging.Y_ADJUSTED, kriging.Z_ADJUSTED)),
+                                     kriging.variogram_model, kriging.variogram_model_parameters)
+        points = _adjust_for_anisotropy(np.asarray(points, dtype=float), [kriging.XCENTER, kriging.YCENTER, kriging.ZCENTER],
+                                        [kriging.anisotropy_scaling_y, kriging.anisotropy_scaling_z],
+                                        [kriging.anisotropy_angle_x, kriging.anisotropy_angle_y, kriging.anisotropy_angle_z])
+
+    # Sort the targets by tile, so that each task is a contiguous range of targets
+    tile_index = np.asarray(grid_index) // tile_size
+    tile_key = np.ravel_multi_index(tile_index.T, tile_index.max(axis=0) + 1)
+    order = np.argsort(tile_key, kind="stable")
+    bounds = np.flatnonzero(np.diff(tile_key[order])) + 1
+    tasks = list(zip(np.r_[0, bounds], np.r_[bounds, n_points]))
+
+    shared_blocks = []
+    try:
+        shared_specs = []
+        for shape, dtype, initial in (((n_points, 3), float, points), ((n_points,), np.int64, order),
+                                      ((n_points,), float, None), ((n_points,), float, None)):
+            shm, _, spec = Create_Shared_Array(shape, dtype, initial=initial)
+            shared_blocks.append(shm)
+            shared_specs.append(spec)
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_kriging_tile_worker,
+                                 initargs=(kriging, shared_specs, backend, system)) as executor:
+            list(executor.map(_krige_tile_worker, *zip(*tasks)))
+
+        predictions = np.ndarray((n_points,), dtype=float, buffer=shared_blocks[2].buf).copy()
+        variances = np.ndarray((n_points,), dtype=float, buffer=shared_blocks[3].buf).copy()
+    finally:
+        Release_Shared_Arrays(shared_blocks)
+
+    return predictions, variances
+
+
+_tile_worker_state = {}
+
+def _init_kriging_tile_worker(kriging, shared_specs, backend, system=None):
+    attached = [Attach_Shared_Array(spec) for spec in shared_specs]
+    _tile_worker_state["blocks"] = [shm for shm, _ in attached]
+    _tile_worker_state["points"], _tile_worker_state["order"], _tile_worker_state["predictions"], _tile_worker_state["variances"] = [array for _, array in attached]
+    _tile_worker_state["kriging"] = kriging
+    _tile_worker_state["backend"] = backend
+    _tile_worker_state["system"] = system
+
+
+def _krige_tile_worker(start, stop, batch_size=4096):
+    index = _tile_worker_state["order"][start:stop]
+    tile_points = _tile_worker_state["points"][index]
+    system = _tile_worker_state["system"]
+    if system is not None:
+        values = np.asarray(_tile_worker_state["kriging"].VALUES, dtype=float)
+        for start in range(0, len(index), batch_size):
+            batch = slice(start, start + batch_size)
+            weights, _tile_worker_state["variances"][index[batch]] = system.solve(tile_points[batch])
+            _tile_worker_state["predictions"][index[batch]] = weights @ values
+        return
+
+    predictions, variances = _tile_worker_state["kriging"].execute(
+        style="points",
+        backend=_tile_worker_state["backend"],
+        xpoints=tile_points[:, 0],
+        ypoints=tile_points[:, 1],
+        zpoints=tile_points[:, 2])
+    _tile_worker_state["predictions"][index] = predictions
+    _tile_worker_state["variances"][index] = variances
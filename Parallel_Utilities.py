@@ -0,0 +1,44 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def Create_Shared_Array(shape, dtype, initial=None):
+    """
+    Allocates an array in shared memory, so that worker processes can read and write it without pickling.
+
+    Parameters:
+        shape (tuple): Shape of the array.
+        dtype (np.dtype): Data type of the array.
+        initial (np.ndarray): Optional values copied into the array.
+
+    Returns:
+        tuple: The SharedMemory block (must be closed and unlinked by the caller), the array on it,
+               and the spec (name, shape, dtype) used by Attach_Shared_Array.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if initial is not None:
+        array[...] = initial
+    return shm, array, (shm.name, tuple(shape), dtype.str)
+
+def Attach_Shared_Array(spec):
+    """
+    Opens, in a worker process, an array created with Create_Shared_Array.
+
+    Parameters:
+        spec (tuple): (name, shape, dtype) returned by Create_Shared_Array.
+
+    Returns:
+        tuple: The SharedMemory block (to keep alive while the array is used) and the array on it.
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def Release_Shared_Arrays(shared_blocks):
+    # Close and free the blocks created with Create_Shared_Array
+    for shm in shared_blocks:
+        shm.close()
+        shm.unlink()
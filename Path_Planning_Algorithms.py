@@ -1,22 +1,21 @@
 #import dijkstra3d
 import Plotter as pl
 import numpy as np
-from Array_Utilities import Separate_NonFluid_Connections
-
-
-import numpy as np
-import heapq
 import heapq
-import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from Instrumentation import Timer, Timed, Count
+
+SQRT2, SQRT3 = np.sqrt(2), np.sqrt(3)
 
 
 class Dijkstra3D:
     """
-    Custom implementation of Dijkstra's algorithm for 3D grids.
+    Dijkstra's algorithm for 3D grids, run on the sparse graph of the non-fluid cells.
     """
 
     @staticmethod
-    def parental_field(volume, source, connectivity=26):
+    def parental_field(volume, source, connectivity=26, fluid_default_value=1):
         """
         Computes the parental field for the given source point in the 3D grid.
 
@@ -24,46 +23,260 @@ class Dijkstra3D:
             volume (np.ndarray): 3D grid representing the volume.
             source (tuple): Coordinates of the source cell (x, y, z).
             connectivity (int): Connectivity for neighbors (6, 18, or 26).
+            fluid_default_value (int): Value of the blocked (fluid) cells.
 
         Returns:
             np.ndarray: Parental field indicating the parent of each cell.
         """
-        
-        # Step 0: Auxiliary variables
+        graph, node_index, node_coords = Dijkstra3D.solid_graph(volume, connectivity, fluid_default_value, include=[source])
+        _, predecessors = Dijkstra3D.shortest_paths(graph, [node_index[source]])
+        return Dijkstra3D.parents_from_predecessors(predecessors[0], node_coords, volume.shape)
+
+    @staticmethod
+    def solid_graph(volume, connectivity=26, fluid_default_value=1, include=()):
+        """
+        Builds the sparse graph of the non-fluid cells, with an edge between neighbor cells weighted
+        by their Euclidean distance.
+
+        Args:
+            volume (np.ndarray): 3D grid representing the volume.
+            connectivity (int): Connectivity for neighbors (6, 18, or 26).
+            fluid_default_value (int): Value of the blocked (fluid) cells.
+            include (list): Cells added to the graph even if they are fluid (e.g. sources).
+
+        Returns:
+            tuple: CSR adjacency matrix, array with the node of each cell (-1 for fluid) and
+                   coordinates of each node, shape (n_nodes, 3).
+        """
+        shape = volume.shape
+        solid = (volume != fluid_default_value)
+        for cell in include:
+            solid[tuple(cell)] = True
+
+        node_coords = np.argwhere(solid)
+        node_index = np.full(shape, -1, dtype=np.int64)
+        node_index[solid] = np.arange(len(node_coords))
+
+        # Each direction and its opposite give the same edges: only half of them are scanned
+        rows, cols, weights = [], [], []
+        for direction, direction_distance in zip(Dijkstra3D.get_directions(connectivity),
+                                                 Dijkstra3D.get_distance_map(Dijkstra3D.get_directions(connectivity))):
+            if direction <= (0, 0, 0):
+                continue
+            origin = tuple(slice(max(-d, 0), s - max(d, 0)) for d, s in zip(direction, shape))
+            neighbor = tuple(slice(max(d, 0), s - max(-d, 0)) for d, s in zip(direction, shape))
+            connected = solid[origin] & solid[neighbor]
+            rows.append(node_index[origin][connected])
+            cols.append(node_index[neighbor][connected])
+            weights.append(np.full(rows[-1].size, direction_distance))
+
+        rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+        graph = csr_matrix((np.concatenate((weights, weights)), (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+                           shape=(len(node_coords), len(node_coords)))
+        return graph, node_index, node_coords
+
+    @staticmethod
+    def shortest_paths(graph, sources, min_only=False, limit=np.inf):
+        """
+        Runs Dijkstra from every source node at once, in compiled code (scipy.sparse.csgraph).
+
+        Args:
+            graph (csr_matrix): Graph from solid_graph.
+            sources (list): Source nodes.
+            min_only (bool): If True, a single field with the distance to the closest source.
+            limit (float): Nodes farther than this from a source are not reached.
+
+        Returns:
+            tuple: Distances and predecessors (-9999 where there is none), shape (n_sources, n_nodes),
+                   or (n_nodes,) plus the closest source of each node if min_only.
+        """
+        return dijkstra(graph, directed=True, indices=np.asarray(sources), return_predecessors=True,
+                        min_only=min_only, limit=limit)
+
+    @staticmethod
+    def astar_path(volume, sources, target, connectivity=26, fluid_default_value=1):
+        """
+        Shortest path between one target and the closest of the given sources, searched with A* from
+        the target and stopped as soon as a source is reached. Only the visited cells are stored, so a
+        single query does not depend on the size of the volume.
+
+        Args:
+            volume (np.ndarray): 3D grid representing the volume.
+            sources (list): Coordinates of the source cells (x, y, z).
+            target (tuple): Coordinates of the target cell (x, y, z).
+            connectivity (int): Connectivity for neighbors (6, 18, or 26).
+            fluid_default_value (int): Value of the blocked (fluid) cells.
+
+        Returns:
+            tuple: List of coordinates from the source to the target (empty if not connected) and
+                   the path length (inf if not connected).
+        """
         directions = Dijkstra3D.get_directions(connectivity)
         distance_map = Dijkstra3D.get_distance_map(directions)
         shape = volume.shape
-        
-        # Step 1: Initialize the unvisited set, distance, and parents
-        # Distance array: Infinity for all except source (set to 0)
-        distances = np.full(shape, np.inf)
-        distances[source] = 0
-        # Parent array: Store the parent coordinate for each cell
-        parents = np.full(shape + (3,), -1, dtype=int)
-        # Priority queue for unvisited nodes
-        priority_queue = [(0, source)]  # (distance, node)
+        target = tuple(int(c) for c in target)
+        sources = np.asarray(sources, dtype=int).reshape(-1, 3)
+        goals = set(map(tuple, sources.tolist()))
+        if not goals or volume[target] == fluid_default_value:
+            return [], float('inf')
 
-        # Step 2–6: Dijkstra's main loop
-        while priority_queue:
-            # Step 3: Select the current node with the smallest distance
-            current_distance, current = heapq.heappop(priority_queue)
-            if current_distance > distances[current]:
-                continue  # Skip if the distance is already updated
+        # Heuristica admissivel: distancia ate a fonte mais proxima ignorando os obstaculos
+        if len(goals) == 1:
+            (goal,) = goals
+            heuristic = lambda node: Dijkstra3D.grid_distance((node[0] - goal[0], node[1] - goal[1], node[2] - goal[2]), connectivity)
+        else:
+            heuristic = lambda node: Dijkstra3D.grid_distance(sources - node, connectivity).min()
 
-            # Step 4: Update distances to neighbors
+        distances = {target: 0.0}
+        parents = {target: None}
+        visited = set()
+        # (distance + heuristic, heuristic, node): ties go to the node closest to the goal
+        priority_queue = [(heuristic(target), heuristic(target), target)]
+        while priority_queue:
+            _, _, current = heapq.heappop(priority_queue)
+            if current in goals:
+                break
+            if current in visited:
+                continue  # Skip if the node was already expanded with a shorter distance
+            visited.add(current)
+            current_distance = distances[current]
             for direction, direction_distance in zip(directions, distance_map):
-                neighbor = tuple(np.add(current, direction))
-                if Dijkstra3D.is_valid(neighbor, shape) and volume[neighbor] != 1:  # Skip blocked cells
+                x, y, z = current[0] + direction[0], current[1] + direction[1], current[2] + direction[2]
+                if not (0 <= x < shape[0] and 0 <= y < shape[1] and 0 <= z < shape[2]):
+                    continue
+                neighbor = (x, y, z)
+                if volume[neighbor] != fluid_default_value or neighbor in goals:
                     new_distance = current_distance + direction_distance
-                    if new_distance < distances[neighbor]:
+                    if new_distance < distances.get(neighbor, np.inf):
                         distances[neighbor] = new_distance
                         parents[neighbor] = current
-                        heapq.heappush(priority_queue, (new_distance, neighbor))
+                        remaining = heuristic(neighbor)
+                        heapq.heappush(priority_queue, (new_distance + remaining, remaining, neighbor))
+        else:
+            return [], float('inf')
 
-            # Step 5: The current node is now visited; it remains final
-            # Implicitly handled since `current` is not re-added to the queue
+        # Search runs from the target, so following the parents walks the path from source to target
+        path = []
+        node = current
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        return path, float(distances[current])
 
-        # Step 6: Return the parental field
+    @staticmethod
+    def grid_distance(delta, connectivity=26):
+        """
+        Length of the shortest obstacle-free path along the grid directions for the given
+        displacements (octile distance for 26 connectivity, Manhattan for 6, Euclidean otherwise).
+
+        Args:
+            delta (tuple): Displacement (dx, dy, dz), or array of displacements with shape (n, 3).
+            connectivity (int): Connectivity for neighbors (6, 18, or 26).
+        """
+        if isinstance(delta, tuple):
+            # Single displacement: plain Python is much faster than numpy for three numbers
+            small, middle, large = sorted(abs(d) for d in delta)
+        else:
+            small, middle, large = np.sort(np.abs(delta), axis=-1).T
+        if connectivity == 6:
+            return small + middle + large
+        if connectivity == 26:
+            return SQRT3*small + SQRT2*(middle - small) + (large - middle)
+        return (small**2 + middle**2 + large**2) ** 0.5
+
+    @staticmethod
+    def k_nearest_sources(graph, sources, k, limit=np.inf):
+        """
+        Distances of every node to its k closest sources, in a single multi-source pass: each node keeps
+        its k best (distance, source) labels, and only the labels that changed relax their edges again,
+        until no label changes. The k closest sources of a node are among the k closest sources of its
+        neighbors, so the labels are exact once they stop changing.
+
+        Args:
+            graph (csr_matrix): Graph from solid_graph.
+            sources (list): Source nodes.
+            k (int): Number of closest sources kept per node.
+            limit (float): Sources farther than this from a node are not kept.
+
+        Returns:
+            tuple: Distances (inf where there is no source) and positions in sources (-1 where there is
+                   none) of the closest sources of each node, sorted by distance, shape (n_nodes, k).
+        """
+        sources = np.asarray(sources)
+        n_nodes = graph.shape[0]
+        graph = graph.tocsr()
+        distances = np.full((n_nodes, k), np.inf)
+        closest = np.full((n_nodes, k), -1, dtype=np.int64)
+        distances[sources, 0] = 0.0
+        closest[sources, 0] = np.arange(sources.size)
+        # Labels not propagated to the neighbors yet
+        fresh = np.zeros((n_nodes, k), dtype=bool)
+        fresh[sources, 0] = True
+
+        frontier = np.unique(sources)
+        while frontier.size > 0:
+            # Edges leaving the frontier, and one candidate label per edge and fresh label of its origin
+            degree = graph.indptr[frontier + 1] - graph.indptr[frontier]
+            edge = np.repeat(graph.indptr[frontier] - np.cumsum(degree) + degree, degree) + np.arange(degree.sum())
+            origin = np.repeat(frontier, degree)
+            origin_label = np.nonzero(fresh[origin])
+            fresh[frontier] = False
+
+            candidate_nodes = graph.indices[edge][origin_label[0]]
+            candidate_distances = distances[origin[origin_label[0]], origin_label[1]] + graph.data[edge][origin_label[0]]
+            candidate_sources = closest[origin[origin_label[0]], origin_label[1]]
+
+            # Only candidates better than the k-th label of their node, from a source it does not already
+            # have at a shorter distance
+            node_distances, node_sources = distances[candidate_nodes], closest[candidate_nodes]
+            better = (candidate_distances <= limit) & (candidate_distances < node_distances[:, -1]) & \
+                     ~np.any((node_sources == candidate_sources[:, np.newaxis]) & (node_distances <= candidate_distances[:, np.newaxis]), axis=1)
+            candidate_nodes, candidate_distances, candidate_sources = candidate_nodes[better], candidate_distances[better], candidate_sources[better]
+            if candidate_nodes.size == 0:
+                break
+
+            # Merge with the current labels: the best distance per (node, source), then the k best per node
+            updated = np.unique(candidate_nodes)
+            current = np.isfinite(distances[updated])
+            nodes = np.concatenate((candidate_nodes, np.repeat(updated, k)[current.ravel()]))
+            node_distances = np.concatenate((candidate_distances, distances[updated][current]))
+            node_sources = np.concatenate((candidate_sources, closest[updated][current]))
+
+            order = np.argsort(node_distances, kind="stable")
+            _, first = np.unique(nodes[order] * sources.size + node_sources[order], return_index=True)
+            order = order[np.sort(first)]
+            order = order[np.argsort(nodes[order], kind="stable")]
+            nodes, node_distances, node_sources = nodes[order], node_distances[order], node_sources[order]
+
+            starts = np.searchsorted(nodes, updated)
+            rank = np.arange(nodes.size) - np.repeat(starts, np.diff(np.append(starts, nodes.size)))
+            kept = rank < k
+            new_distances = np.full((updated.size, k), np.inf)
+            new_closest = np.full((updated.size, k), -1, dtype=np.int64)
+            row = np.searchsorted(updated, nodes[kept])
+            new_distances[row, rank[kept]] = node_distances[kept]
+            new_closest[row, rank[kept]] = node_sources[kept]
+
+            # A label is fresh if its source was not a label of the node at that distance
+            old_distances, old_closest = distances[updated], closest[updated]
+            unchanged = np.any((new_closest[:, :, np.newaxis] == old_closest[:, np.newaxis, :]) &
+                               (new_distances[:, :, np.newaxis] == old_distances[:, np.newaxis, :]), axis=2)
+            new_fresh = ~unchanged & (new_closest >= 0)
+            distances[updated], closest[updated] = new_distances, new_closest
+            fresh[updated] |= new_fresh
+            frontier = updated[np.any(new_fresh, axis=1)]
+
+        return distances, closest
+
+    @staticmethod
+    def parents_from_predecessors(predecessors, node_coords, shape):
+        """
+        Converts the predecessors of one source into the parental field format (parent coordinates
+        of each cell, -1 for the source and unreached cells).
+        """
+        parents = np.full(shape + (3,), -1, dtype=int)
+        reached = predecessors >= 0
+        parents[tuple(node_coords[reached].T)] = node_coords[predecessors[reached]]
         return parents
 
     @staticmethod
@@ -87,6 +300,29 @@ class Dijkstra3D:
         path.reverse()
         return path
 
+    @staticmethod
+    def path_from_predecessors(predecessors, node_index, node_coords, target):
+        """
+        Reconstructs the path from the source to the target using the predecessors of one source.
+
+        Args:
+            predecessors (np.ndarray): Predecessor of each node, from `shortest_paths`.
+            node_index (np.ndarray): Node of each cell, from `solid_graph`.
+            node_coords (np.ndarray): Coordinates of each node, from `solid_graph`.
+            target (tuple): Coordinates of the target cell (x, y, z).
+
+        Returns:
+            list: List of coordinates representing the path from source to target.
+        """
+        path = []
+        current = node_index[tuple(target)]
+        while current >= 0:  # Continue until the source is reached
+            path.append(tuple(int(c) for c in node_coords[current]))
+            current = predecessors[current]
+
+        path.reverse()
+        return path
+
     @staticmethod
     def get_directions(connectivity):
         """
@@ -139,69 +375,110 @@ class Dijkstra3D:
         return all(0 <= c < s for c, s in zip(coord, shape))
 
     
-def FindPaths(volume, fluid_default_value=1, solid_default_value=0):
-    dijkstra3d = Dijkstra3D()
+class PathField:
+    """
+    Shortest paths from a set of source cells to every non-fluid cell, stored compactly as one
+    predecessor array (int32) and one distance array (float32) per source. Paths are rebuilt only
+    when requested, and cells are found in O(1) through a volume of node indices.
+    """
+
+    def __init__(self, sources, predecessors, distances, node_index, node_coords):
+        self.sources = [tuple(int(c) for c in source) for source in sources]
+        self.predecessors = predecessors.astype(np.int32)
+        self.distances = distances.astype(np.float32)
+        self.node_index = node_index.astype(np.int32)
+        self.node_coords = node_coords.astype(np.int32)
+        self._source_position = {source: i for i, source in enumerate(self.sources)}
 
-    sub_solid_arrays, connected_labels, labels = Separate_NonFluid_Connections(volume, fluid_default_value)
+    def __len__(self):
+        return len(self.sources)
+
+    def _source(self, source):
+        # Sources can be given by position in self.sources or by coordinates
+        return source if isinstance(source, (int, np.integer)) else self._source_position[tuple(source)]
+
+    def distance(self, source, target):
+        """Geodesic distance from source to target (inf if not connected)."""
+        node = self.node_index[tuple(target)]
+        return float(self.distances[self._source(source), node]) if node >= 0 else float('inf')
+
+    def path(self, source, target):
+        """List of coordinates from source to target, or an empty list if they are not connected."""
+        i = self._source(source)
+        if not np.isfinite(self.distance(i, target)):
+            return []
+        return Dijkstra3D.path_from_predecessors(self.predecessors[i], self.node_index, self.node_coords, target)
+
+    def paths_to(self, target):
+        """Dictionary with the path from each connected source to target."""
+        return {source: self.path(i, target) for i, source in enumerate(self.sources)
+                if np.isfinite(self.distance(i, target))}
+
+    def closest_source(self, target):
+        """Source with the shortest path to target (None if no source is connected)."""
+        node = self.node_index[tuple(target)]
+        if node < 0 or len(self.sources) == 0:
+            return None
+        i = int(np.argmin(self.distances[:, node]))
+        return self.sources[i] if np.isfinite(self.distances[i, node]) else None
+
+
+@Timed()
+def FindPaths(volume, fluid_default_value=1, solid_default_value=0, connectivity=26):
+    dijkstra3d = Dijkstra3D()
 
     print("Running FindPaths")
-    print(f"Domain spliited into {len(sub_solid_arrays)} sub-arrays")
-    
-    for group_i,solid_array in enumerate(sub_solid_arrays):
-        print(f"\nSub-Array {group_i} under analysis: ")
+
+    # Celulas Source - Pontos de Medida
+    source_cells = np.argwhere((volume != fluid_default_value) & (volume != solid_default_value))
+
+    # Celulas Target - Qualquer ponto solido (nao fluido). Celulas de grupos solidos diferentes nao
+    # sao conectadas no grafo, e portanto nao sao alcancadas
+    with Timer("solid_graph"):
+        graph, node_index, node_coords = dijkstra3d.solid_graph(volume, connectivity=connectivity, fluid_default_value=fluid_default_value)
+    print("Pontos de medicao: ", len(source_cells), " source cells")
+    print("Celulas solidas: ", len(node_coords), " target cells")
+    Count("path_sources", len(source_cells))
+    Count("path_targets", len(node_coords))
+
+    # Gerar o campo parental de todas as fontes de uma vez
+    with Timer("shortest_paths"):
+        distances, predecessors = dijkstra3d.shortest_paths(graph, node_index[tuple(source_cells.T)])
+
+    return PathField(source_cells, predecessors, distances, node_index, node_coords)
+
+
+@Timed()
+def FindPath(volume, target, sources=None, fluid_default_value=1, solid_default_value=0, connectivity=26):
+    """
+    Point-to-point query: shortest path from the closest source to target, without computing the
+    paths to every cell as FindPaths does.
+
+    Parameters:
+        volume (np.ndarray): 3D grid representing the volume.
+        target (tuple): Coordinates of the target cell (x, y, z).
+        sources (list): Source cells. Defaults to every measurement cell of the volume.
+
+    Returns:
+        tuple: List of coordinates from the source to the target (empty if not connected) and the path length.
+    """
+    if sources is None:
         # Celulas Source - Pontos de Medida
-        source_cells = np.argwhere((solid_array != fluid_default_value) & (solid_array != solid_default_value))
-        source_cells = [tuple(cell) for cell in source_cells] # Conversao para formato usado na implementacao Djikstra
-        
-        
-        # Celulas Target - Qualquer ponto solido (nao fluido)
-        target_cells = np.argwhere(solid_array != fluid_default_value)
-        target_cells = [tuple(cell) for cell in target_cells] # Conversao para formato usado na implementacao Djikstra
-        
-        
-        # Gerar o campo parental para cada fonte e calcular os caminhos
-        all_paths = []
-        print("Pontos de medicao: ", len(source_cells), " source cells")
-        print("Celulas solidas: ", len(target_cells), " target cells")
-        
-        # Para cada source
-        for source in source_cells:
-            # Gerar o campo parental para a fonte atual: 
-            print("- Analysis source: ", source)
-            
-            parents = dijkstra3d.parental_field(solid_array, source=source, connectivity=26)
-        
-            source_paths = { "source": source,
-                             "target_paths": []}
-
-            for it, target in enumerate(target_cells):
-                
-                if int(100 * it / len(target_cells)) % 10 == 0 and int(100 * (it - 1) / len(target_cells)) % 10 != 0: print(f"-- Dijkstra run: {int(100 * it / len(target_cells))}% of {len(target_cells)} runs")
-
-                target = tuple(target)
-                if target != source:  
-                    
-                    # Reconstroi o caminho ate cada target
-                    path = dijkstra3d.path_from_parents(parents, target)
-                    # Registra caminho
-                    source_paths["target_paths"].append({"target":target,"path": path})
-                    
-     
-            all_paths.append(source_paths)
-            
-        return all_paths
-    
-def PlotPath_fromSources(volume, all_paths, target, fill_value=10):
-    
-    path = []
-    for path_info in all_paths:
-        source = path_info["source"]
-        
-        for target_path_dict in path_info["target_paths"]:
-            
-            if target_path_dict["target"] == target:
-                path = target_path_dict["path"]            
-                
+        sources = np.argwhere((volume != fluid_default_value) & (volume != solid_default_value))
+    return Dijkstra3D.astar_path(volume, sources, target, connectivity=connectivity, fluid_default_value=fluid_default_value)
+
+
+def PlotPath_fromSources(volume, all_paths, target, fill_value=10, source=None):
+    # Caminho ate o target a partir da fonte escolhida, ou da fonte mais proxima. Sem all_paths
+    # (FindPaths), o caminho e buscado diretamente com A*
+    if all_paths is None:
+        path, _ = FindPath(volume, target, sources=None if source is None else [source])
+    else:
+        source = all_paths.closest_source(target) if source is None else source
+        path = all_paths.path(source, target) if source is not None else []
+    if not path:
+        raise ValueError(f"No source is connected to the target {target}")
+
     final_volume = volume.copy()
     for point in path:
         i,j,k = point
@@ -211,4 +488,3 @@ def PlotPath_fromSources(volume, all_paths, target, fill_value=10):
     final_volume[target[0],target[1],target[2]] = fill_value*10
         
     pl.Plot_Domain(final_volume, "TESTE", remove_value=[1]) 
-    
\ No newline at end of file
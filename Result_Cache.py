@@ -0,0 +1,128 @@
+import numpy as np
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+# Part of every key: changing it invalidates the results cached by previous versions of the interpolation
+CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    Disk cache of interpolation results, addressed by content: the key of an entry is a hash of the
+    input array bytes (e.g. the crop of a solid group, samples included) and of the interpolation
+    parameters, so a changed sample or parameter simply gives a different key.
+
+    Each entry is a .npz file with named arrays. The least recently used entries (by file modification
+    time, updated on every hit) are removed when the cache exceeds max_bytes. The entries are indexed
+    in memory in order of use, so the folder is only scanned when the cache is created (or by evict).
+
+    Several processes can share a cache folder: entries are written to a temporary file and renamed.
+    Each process limits the size of the entries it knows (those present at its start, and those it
+    stored or read); evict() also counts the entries stored since by the other processes.
+    """
+
+    def __init__(self, folder, max_bytes=2**30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        # Size of the known entries, least recently used first, and their total
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self.evict()
+
+    @staticmethod
+    def key(*arrays, **parameters):
+        # Hash of the shape, data type and bytes of every array, and of the parameters (JSON-serializable)
+        digest = hashlib.sha256()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(json.dumps([array.shape, array.dtype.str]).encode())
+            digest.update(array.data)
+        digest.update(json.dumps({"cache_version": CACHE_VERSION, **parameters}, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self.folder, key + ".npz")
+
+    def get(self, key):
+        """
+        Returns:
+            dict: The arrays stored with key, or None if the entry does not exist (or was evicted meanwhile).
+        """
+        file_name = self._file_name(key)
+        try:
+            with np.load(file_name) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+        # Most recently used
+        try:
+            os.utime(file_name)
+            if key not in self._entries:
+                self._add_entry(key, os.path.getsize(file_name))
+            self._entries.move_to_end(key)
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, key, **arrays):
+        # Stores the named arrays under key, then evicts the least recently used entries above max_bytes
+        handle, temporary_file = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez(file, **arrays)
+                size = file.tell()
+            os.replace(temporary_file, self._file_name(key))
+        except BaseException:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+            raise
+
+        self._add_entry(key, size)
+        self._remove_least_recent()
+
+    def _add_entry(self, key, size):
+        self._total_bytes += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+
+    def _remove_least_recent(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._file_name(key))
+            except OSError:
+                pass
+
+    def evict(self):
+        # Indexes the entries of the folder again (by modification time) and removes the least recently used above max_bytes
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npz"):
+                try:
+                    status = entry.stat()
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.name[:-len(".npz")]))
+
+        self._entries.clear()
+        self._total_bytes = 0
+        for _, size, key in sorted(entries):
+            self._add_entry(key, size)
+        self._remove_least_recent()
+
+    def size(self):
+        # Bytes used by the entries
+        return sum(entry.stat().st_size for entry in os.scandir(self.folder) if entry.name.endswith(".npz"))
+
+    def clear(self):
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npz"):
+                os.remove(entry.path)
+        self._entries.clear()
+        self._total_bytes = 0
@@ -0,0 +1,212 @@
+import numpy as np
+import os
+import tempfile
+from scipy.ndimage import label, generate_binary_structure
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from Array_Utilities import Remove_Internal_Solid, Smallest_Label_Dtype
+from pykrige.uk3d import UniversalKriging3D
+from Kriging_Algorithms import LocalKriging3D
+from Volume_IO import Create_Volume, Volume_Slabs
+from Instrumentation import Timer, Timed, Count
+
+# Estimated memory per cell of a slab: input and surface planes, label planes (int32 and final dtype),
+# the two output planes, erosion masks and the coordinates of the target cells
+SLAB_BYTES_PER_CELL = 64
+
+
+@Timed()
+def interpolate_solid_connection_surfaces_slabs(volume, fluid_default=1, file_name="", memory_budget=2**30, slab_size=None,
+                                                n_neighbors=16, search_radius=None, variogram_model="linear"):
+    """
+    Out-of-core version of interpolate_solid_connection_surfaces: the volume (e.g. a np.memmap from
+    Volume_IO.Open_Volume) is processed in slabs of planes along the first axis, and the results are
+    written to the output files slab by slab, so memory is bounded by memory_budget instead of the volume.
+
+    Steps:
+        1. Surface extraction, slab by slab with a one-voxel halo (Remove_Internal_Solid).
+        2. Labels of the solid groups, per slab, stitched across the slab boundaries (Label_Slabs).
+        3. Sample cells of every group gathered from all the slabs (samples are few).
+        4. Each slab is interpolated with the samples of the groups it contains: local kriging with the
+           n_neighbors closest samples of the group, and nearest neighbor. Since the samples are global,
+           the neighborhoods do not depend on the slabs.
+
+    Parameters:
+        file_name (str): Base name of the output files (required).
+        memory_budget (int): Bytes available for the slabs, used to choose slab_size if not given.
+        n_neighbors (int): Samples used to krige each cell, or None for global kriging with all the
+                           samples of the group (the kriging of interpolate_solid_connection_surfaces
+                           by default).
+
+    Returns:
+        tuple: Memory maps of the kriging and nearest neighbor output files.
+    """
+    if file_name == "":
+        raise ValueError("file_name is required: the results are written to disk slab by slab")
+    if slab_size is None:
+        slab_size = Slab_Size_From_Budget(volume.shape, memory_budget)
+    print("-Out-of-core surface interpolation, slabs of ", slab_size, " planes")
+
+    krig_out, _ = Create_Volume(file_name+"_Surface_SolConn_krig.raw", volume.shape, np.uint8, fluid_default_value=fluid_default)
+    nn_out, _ = Create_Volume(file_name+"_Surface_SolConn_nn.raw", volume.shape, np.uint8, fluid_default_value=fluid_default)
+
+    # Intermediate volumes are memory-mapped next to the outputs, and removed at the end
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(file_name))) as scratch_folder:
+        surface, _ = Create_Volume(os.path.join(scratch_folder, "surface.raw"), volume.shape, np.uint8, fluid_default_value=fluid_default)
+        with Timer("surface_extraction"):
+            Remove_Internal_Solid(volume, fluid_default_value=fluid_default, slab_size=slab_size, out=surface)
+
+        with Timer("component_labelling"):
+            labels, n_groups = Label_Slabs(surface, fluid_default, slab_size, os.path.join(scratch_folder, "labels.raw"))
+        print("---Array diveded into ", n_groups, " groups. ")
+        Count("components", n_groups)
+
+        with Timer("sample_extraction"):
+            samples, sample_groups, sample_angles = Gather_Slab_Samples(surface, labels, slab_size)
+        Count("samples", len(sample_angles))
+
+        interpolators = {}
+        with Timer("variogram_fit"):
+            for group in np.unique(sample_groups):
+                in_group = (sample_groups == group)
+                print("---Group ", group, ", Sample cells: ", np.sum(in_group))
+                interpolators[group] = _Group_Interpolator(samples[in_group], sample_angles[in_group], n_neighbors, search_radius, variogram_model)
+
+        for planes in Volume_Slabs(volume.shape, slab_size):
+            surface_slab = np.asarray(surface[planes])
+            krig_slab, nn_slab = surface_slab.copy(), surface_slab.copy()
+
+            # Group cells of the slab, sorted by group. Groups without samples keep their original cells
+            label_slab = np.asarray(labels[planes])
+            cells = np.nonzero(label_slab)
+            cell_groups = label_slab[cells]
+            order = np.argsort(cell_groups, kind="stable")
+            slab_groups, group_starts = np.unique(cell_groups[order], return_index=True)
+
+            for group, group_cells in zip(slab_groups, np.split(order, group_starts[1:])):
+                if group not in interpolators:
+                    continue
+                index = tuple(axis[group_cells] for axis in cells)
+                points = np.column_stack(index).astype(float)
+                points[:, 0] += planes.start
+                with Timer("interpolation"):
+                    krig_slab[index], nn_slab[index] = interpolators[group](points)
+                Count("kriging_systems", len(points))
+
+            with Timer("write"):
+                krig_out[planes] = krig_slab
+                nn_out[planes] = nn_slab
+
+        del surface, labels
+
+    krig_out.flush()
+    nn_out.flush()
+    return krig_out, nn_out
+
+
+def Slab_Size_From_Budget(shape, memory_budget, bytes_per_cell=SLAB_BYTES_PER_CELL, halo=1):
+    """
+    Largest number of planes (along the first axis) of a slab whose cells, plus a halo on each
+    side, fit in memory_budget bytes.
+    """
+    plane_bytes = bytes_per_cell * shape[1] * shape[2]
+    slab_size = int(memory_budget // plane_bytes) - 2 * halo
+    if slab_size < 1:
+        raise ValueError(f"Memory budget of {memory_budget} bytes is smaller than a slab of one plane ({(1 + 2*halo) * plane_bytes} bytes)")
+    return min(slab_size, shape[0])
+
+
+def Label_Slabs(volume, fluid_default, slab_size, labels_file):
+    """
+    Labels the connected non-fluid groups (18-connectivity, as Label_NonFluid_Connections) slab by slab.
+    Labels touching across a slab boundary are merged, and the groups are numbered in the order of
+    their first cell, as labelling the whole volume at once would.
+
+    Returns:
+        tuple: Memory map of the labels (0 on fluid), written on labels_file, and the number of groups.
+    """
+    structure = generate_binary_structure(rank=3, connectivity=2)
+    label_dtype = Smallest_Label_Dtype(np.prod(volume.shape))
+    labels, _ = Create_Volume(labels_file, volume.shape, label_dtype)
+
+    # First pass: labels of each slab, offset to be unique, and pairs of labels touching the previous slab
+    n_labels = 0
+    touching = []
+    previous_plane = None
+    for planes in Volume_Slabs(volume.shape, slab_size):
+        slab_labels, n_slab_labels = label(np.asarray(volume[planes]) != fluid_default, structure=structure)
+        slab_labels = slab_labels.astype(label_dtype)
+        slab_labels[slab_labels > 0] += n_labels
+        if previous_plane is not None:
+            touching.append(_Touching_Labels(previous_plane, slab_labels[0], structure))
+
+        labels[planes] = slab_labels
+        previous_plane = slab_labels[-1].copy()
+        n_labels += n_slab_labels
+
+    # Merge touching labels: groups are the connected components of the graph of labels
+    touching = np.concatenate(touching) if touching else np.empty((0, 2), dtype=np.int64)
+    graph = csr_matrix((np.ones(len(touching)), (touching[:, 0], touching[:, 1])), shape=(n_labels + 1, n_labels + 1))
+    _, component = connected_components(graph, directed=False)
+
+    # Labels are in scan order, so the first label of a component gives the order of its first cell
+    _, first_label, label_component = np.unique(component, return_index=True, return_inverse=True)
+    component_group = np.empty(len(first_label), dtype=label_dtype)
+    component_group[np.argsort(first_label)] = np.arange(len(first_label))
+    relabel = component_group[label_component]
+
+    # Second pass: final group of each cell
+    for planes in Volume_Slabs(volume.shape, slab_size):
+        labels[planes] = relabel[np.asarray(labels[planes])]
+
+    return labels, len(first_label) - 1
+
+
+def _Touching_Labels(plane, next_plane, structure):
+    # Pairs of labels of neighbor cells in consecutive planes (neighbors as given by structure)
+    pairs = []
+    for dy, dz in np.argwhere(structure[2]) - 1:
+        rows = slice(max(-dy, 0), plane.shape[0] - max(dy, 0)), slice(max(-dz, 0), plane.shape[1] - max(dz, 0))
+        next_rows = slice(max(dy, 0), plane.shape[0] - max(-dy, 0)), slice(max(dz, 0), plane.shape[1] - max(-dz, 0))
+        labels, next_labels = plane[rows], next_plane[next_rows]
+        both = (labels > 0) & (next_labels > 0)
+        pairs.append(np.column_stack((labels[both], next_labels[both])).astype(np.int64))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def Gather_Slab_Samples(volume, labels, slab_size):
+    """
+    Collects the sample cells (neither 0 nor 1) of the labelled groups of a volume, slab by slab.
+
+    Returns:
+        tuple: Coordinates (n_samples, 3), group labels and angles of the samples.
+    """
+    samples, groups, angles = [], [], []
+    for planes in Volume_Slabs(volume.shape, slab_size):
+        slab, label_slab = np.asarray(volume[planes]), np.asarray(labels[planes])
+        index = np.nonzero((slab != 0) & (slab != 1) & (label_slab != 0))
+        samples.append(np.column_stack((index[0] + planes.start, index[1], index[2])))
+        groups.append(label_slab[index])
+        angles.append(slab[index].astype(float))
+    return np.concatenate(samples), np.concatenate(groups), np.concatenate(angles)
+
+
+def _Group_Interpolator(samples, angle, n_neighbors, search_radius, variogram_model):
+    # Returns a function giving the kriging and nearest neighbor values of a group at the given points
+    tree = cKDTree(samples)
+    nearest_neighbor = lambda points: angle[tree.query(points)[1]]
+
+    # Mesmos casos especiais de Apply_Kriging: amostras iguais ou ate 2 amostras
+    if np.all(angle == angle[0]) or angle.size <= 2:
+        kriging = lambda points: np.full(len(points), angle.mean())
+    elif n_neighbors is None:
+        # Global kriging, as Apply_Kriging without n_neighbors
+        global_kriging = UniversalKriging3D(samples[:, 0], samples[:, 1], samples[:, 2], angle, variogram_model=variogram_model)
+        kriging = lambda points: global_kriging.execute("points", points[:, 0], points[:, 1], points[:, 2], backend="loop")[0]
+    else:
+        local_kriging = LocalKriging3D(samples[:, 0], samples[:, 1], samples[:, 2], angle, variogram_model=variogram_model,
+                                       n_neighbors=n_neighbors, search_radius=search_radius)
+        kriging = lambda points: local_kriging.execute("points", points[:, 0], points[:, 1], points[:, 2])[0]
+
+    return lambda points: (kriging(points), nearest_neighbor(points))
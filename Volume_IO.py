@@ -0,0 +1,116 @@
+import numpy as np
+import json
+import os
+
+
+def Metadata_File_Name(file_name):
+    # Sidecar of "Volume.raw" is "Volume.json"
+    return os.path.splitext(file_name)[0] + ".json"
+
+def Write_Volume_Metadata(file_name, shape, dtype=np.uint8, fluid_default_value=1, solid_default_value=0, voxel_size=1.0):
+    """
+    Writes the sidecar of a .raw volume with the information needed to open it.
+
+    Parameters:
+        file_name (str): Path of the .raw file.
+        shape (tuple): Shape of the volume (x, y, z).
+        dtype (np.dtype): Data type of the cells.
+        fluid_default_value (int): Value of the fluid cells.
+        solid_default_value (int): Value of the solid cells without samples.
+        voxel_size (float): Edge length of a cell.
+
+    Returns:
+        dict: The written metadata.
+    """
+    metadata = {"shape": [int(s) for s in shape],
+                "dtype": np.dtype(dtype).str,
+                "fluid_default_value": int(fluid_default_value),
+                "solid_default_value": int(solid_default_value),
+                "voxel_size": float(voxel_size)}
+    with open(Metadata_File_Name(file_name), "w") as file:
+        json.dump(metadata, file, indent=4)
+    return metadata
+
+def Read_Volume_Metadata(file_name, volume_shape=None, dtype=np.uint8, fluid_default_value=1, solid_default_value=0, voxel_size=1.0):
+    """
+    Reads the sidecar of a .raw volume. Volumes without sidecar (older files) need volume_shape, and
+    the remaining arguments are used as their metadata.
+
+    Returns:
+        dict: shape, dtype, fluid_default_value, solid_default_value and voxel_size.
+    """
+    sidecar = Metadata_File_Name(file_name)
+    if os.path.exists(sidecar):
+        with open(sidecar) as file:
+            metadata = json.load(file)
+    elif volume_shape is not None:
+        metadata = {"shape": list(volume_shape), "dtype": np.dtype(dtype).str, "fluid_default_value": fluid_default_value,
+                    "solid_default_value": solid_default_value, "voxel_size": voxel_size}
+    else:
+        raise FileNotFoundError(f"No metadata file {sidecar}: provide the volume shape")
+
+    metadata["shape"] = tuple(metadata["shape"])
+    return metadata
+
+def Open_Volume(file_name, mode="r", volume_shape=None, dtype=np.uint8, fluid_default_value=1, solid_default_value=0, voxel_size=1.0):
+    """
+    Opens a .raw volume as a memory map: cells are read from disk only when accessed.
+
+    Parameters:
+        file_name (str): Path of the .raw file.
+        mode (str): "r" (read only), "r+" (read and write) or "c" (writes kept in memory only).
+        volume_shape, dtype, ...: Metadata used if the volume has no sidecar (see Read_Volume_Metadata).
+
+    Returns:
+        tuple: The memory-mapped volume and its metadata.
+    """
+    metadata = Read_Volume_Metadata(file_name, volume_shape, dtype, fluid_default_value, solid_default_value, voxel_size)
+
+    expected_size = int(np.prod(metadata["shape"])) * np.dtype(metadata["dtype"]).itemsize
+    if os.path.getsize(file_name) != expected_size:
+        raise ValueError(f"{file_name} has {os.path.getsize(file_name)} bytes, expected {expected_size} for shape {metadata['shape']}")
+
+    volume = np.memmap(file_name, dtype=np.dtype(metadata["dtype"]), mode=mode, shape=metadata["shape"])
+    return volume, metadata
+
+def Create_Volume(file_name, shape, dtype=np.uint8, fluid_default_value=1, solid_default_value=0, voxel_size=1.0, initial=None, slab_size=64):
+    """
+    Creates a .raw volume (and its sidecar) as a writable memory map, optionally filled with initial.
+
+    Parameters:
+        initial (np.ndarray): Values copied into the volume, slab_size planes at a time.
+
+    Returns:
+        tuple: The memory-mapped volume and its metadata.
+    """
+    # Verificar se a pasta existe, caso contrário, criar
+    folder = os.path.dirname(file_name)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    volume = np.memmap(file_name, dtype=np.dtype(dtype), mode="w+", shape=tuple(shape))
+    if initial is not None:
+        for planes in Volume_Slabs(shape, slab_size):
+            volume[planes] = initial[planes]
+    metadata = Write_Volume_Metadata(file_name, shape, dtype, fluid_default_value, solid_default_value, voxel_size)
+    return volume, metadata
+
+def Save_Volume(file_name, volume, fluid_default_value=1, solid_default_value=0, voxel_size=1.0, slab_size=64):
+    """
+    Saves volume as a .raw file with its sidecar. If volume is already the memory map of this file,
+    only the pending writes are flushed.
+    """
+    if isinstance(volume, np.memmap) and volume.filename is not None and os.path.abspath(volume.filename) == os.path.abspath(file_name):
+        volume.flush()
+        Write_Volume_Metadata(file_name, volume.shape, volume.dtype, fluid_default_value, solid_default_value, voxel_size)
+        return
+
+    saved, _ = Create_Volume(file_name, volume.shape, volume.dtype, fluid_default_value, solid_default_value, voxel_size,
+                             initial=volume, slab_size=slab_size)
+    saved.flush()
+    del saved
+
+def Volume_Slabs(shape, slab_size=64):
+    # Slices of consecutive planes along the first axis, covering the volume
+    for start in range(0, shape[0], slab_size):
+        yield slice(start, min(start + slab_size, shape[0]))
@@ -1,42 +1,54 @@
 from Plotter import Plot_Domain, Plot_Sliced_Planes
-import numpy as np
-from Interpolation_Algorithms import interpolate_solid, interpolate_solid_connections, interpolate_solid_connection_surfaces  
+from Interpolation_Algorithms import interpolate_solid, interpolate_solid_connections, interpolate_solid_connection_surfaces, interpolate_solid_connection_surfaces_geodesic
 from Array_Utilities import Remove_Internal_Solid 
 from Path_Planning_Algorithms import FindPaths, PlotPath_fromSources
+from Volume_IO import Open_Volume
+from Instrumentation import Instrumented_Run
+from Result_Cache import ResultCache
 
 
-def Interpolation_Progress(input_file_name, output_base_folder_name, title, volume_shape, fluid_default_value=1):
+def Interpolation_Progress(input_file_name, output_base_folder_name, title, volume_shape=None, fluid_default_value=1, trace_memory=False,
+                           cache_max_bytes=2**30):
+    # Interpolated groups are cached (by content) in the output folder: reruns only recompute the groups that changed
+    cache = ResultCache(output_base_folder_name+"cache/", max_bytes=cache_max_bytes)
+    # Timers and counters of the run are saved as a JSON report per volume
+    report_file_name = output_base_folder_name+"reports/"+title+"_report.json"
+    with Instrumented_Run(report_file_name, trace_memory=trace_memory, volume=input_file_name, title=title):
+        # Open Solid: memory-mapped, with shape and fluid value from the sidecar (volume_shape and
+        # fluid_default_value are only used for volumes without sidecar)
+        volume_array, metadata = Open_Volume(input_file_name, volume_shape=volume_shape, fluid_default_value=fluid_default_value)
+        fluid_default_value = metadata["fluid_default_value"]
+        """  
+        # Full-solid interpolation
+        krig_final_domain, nn_final_domain = interpolate_solid(volume_array,fluid_default_value=fluid_default_value, file_name=output_base_folder_name+"raw/"+title)
+        Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig", remove_value=[fluid_default_value])
+        Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn", remove_value=[fluid_default_value])
+        Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_slicedPlanes")
+        Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_nn_slicedPlanes")
+        print(output_base_folder_name+"html/"+title+"_nn_slicedPlanes")
     
+        # Solid Connected only
+        print("Solid Connected only interpolation")
+        krig_final_domain, nn_final_domain = interpolate_solid_connections(volume_array, fluid_default=fluid_default_value, file_name=output_base_folder_name+"raw/"+title, cache=cache) 
+        Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig_SolConn", remove_value=[fluid_default_value])  
+        Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn_SolConn", remove_value=[fluid_default_value])
+        Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_SolConn_slicedPlanes")
+        Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_n_SolConnn_slicedPlanes")
     
-    # Open Solid 
-    volume_array = np.fromfile(input_file_name, dtype=np.uint8).reshape(volume_shape)
-    """  
-    # Full-solid interpolation
-    krig_final_domain, nn_final_domain = interpolate_solid(volume_array,fluid_default_value=fluid_default_value, file_name=output_base_folder_name+"raw/"+title)
-    Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig", remove_value=[fluid_default_value])
-    Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn", remove_value=[fluid_default_value])
-    Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_slicedPlanes")
-    Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_nn_slicedPlanes")
-    print(output_base_folder_name+"html/"+title+"_nn_slicedPlanes")
-    
-    # Solid Connected only
-    print("Solid Connected only interpolation")
-    krig_final_domain, nn_final_domain = interpolate_solid_connections(volume_array, fluid_default=fluid_default_value, file_name=output_base_folder_name+"raw/"+title) 
-    Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig_SolConn", remove_value=[fluid_default_value])  
-    Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn_SolConn", remove_value=[fluid_default_value])
-    Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_SolConn_slicedPlanes")
-    Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_n_SolConnn_slicedPlanes")
-    
-    """ 
-    # Surface Solid Connections only interpolation
-    print("Solid Surface Connected only interpolation")
-    krig_final_domain, nn_final_domain = interpolate_solid_connection_surfaces(volume_array, fluid_default=fluid_default_value, file_name=output_base_folder_name+"raw/"+title) 
-    Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig_Surface_SolConn", remove_value=[fluid_default_value])
-    Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn_Surface_SolConn", remove_value=[fluid_default_value])
-    Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_Surface_SolConn_slicedPlanes")
-    Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_nn_Surface_SolConn_slicedPlanes")
+        """ 
+        # Surface Solid Connections only interpolation
+        print("Solid Surface Connected only interpolation")
+        krig_final_domain, nn_final_domain = interpolate_solid_connection_surfaces(volume_array, fluid_default=fluid_default_value, file_name=output_base_folder_name+"raw/"+title, cache=cache) 
+        Plot_Domain(krig_final_domain, output_base_folder_name+"png/"+title+"_krig_Surface_SolConn", remove_value=[fluid_default_value])
+        Plot_Domain(nn_final_domain, output_base_folder_name+"png/"+title+"_nn_Surface_SolConn", remove_value=[fluid_default_value])
+        Plot_Sliced_Planes(krig_final_domain, file_name=output_base_folder_name+"html/"+title+"_krig_Surface_SolConn_slicedPlanes")
+        Plot_Sliced_Planes(nn_final_domain, file_name=output_base_folder_name+"html/"+title+"_nn_Surface_SolConn_slicedPlanes")
 
-    # Surface Path Interpolation 
+        # Surface Path Interpolation
+        print("Solid Surface geodesic interpolation")
+        idw_final_domain = interpolate_solid_connection_surfaces_geodesic(volume_array, fluid_default=fluid_default_value, file_name=output_base_folder_name+"raw/"+title)
+        Plot_Domain(idw_final_domain, output_base_folder_name+"png/"+title+"_idw_Surface_Geodesic", remove_value=[fluid_default_value])
+        Plot_Sliced_Planes(idw_final_domain, file_name=output_base_folder_name+"html/"+title+"_idw_Surface_Geodesic_slicedPlanes")
     
 """
 # OK    
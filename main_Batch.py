@@ -0,0 +1,308 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+from Volume_IO import Open_Volume, Metadata_File_Name
+from Instrumentation import Instrumented_Run
+from Result_Cache import ResultCache
+
+# Interpolation methods of a job and the suffixes of their output files (after <output_folder>raw/<title>)
+METHOD_OUTPUTS = {"solid": ["_krig.raw", "_nn.raw"],
+                  "solid_connections": ["_SolConn_krig.raw", "_SolConn_nn.raw"],
+                  "surfaces": ["_Surface_SolConn_krig.raw", "_Surface_SolConn_nn.raw"],
+                  "geodesic": ["_Surface_Geodesic_idw.raw"]}
+
+# Values of the job keys missing from the manifest
+JOB_DEFAULTS = {"shape": None,
+                "fluid_default_value": 1,
+                "methods": ["surfaces", "geodesic"],
+                "output_folder": "Interpolated Volumes/",
+                "memory_budget": None,
+                "cache_folder": None,
+                "plots": False,
+                "trace_memory": False}
+
+SUMMARY_FIELDS = ["title", "input", "status", "wall_time_s", "peak_rss_bytes", "methods", "outputs", "error"]
+
+
+def Read_Manifest(file_name):
+    """
+    Reads the jobs of a batch. The manifest is either:
+        - JSON: a list of jobs, or {"defaults": {...}, "jobs": [...]}, each job a dict with the keys of
+          JOB_DEFAULTS plus "input" (path of the .raw volume) and optionally "title";
+        - CSV: one job per row, with the same columns; shape as "50x50x50" and methods separated by ";".
+
+    Returns:
+        list: Jobs with every key filled in (title defaults to the name of the input file).
+    """
+    defaults = dict(JOB_DEFAULTS)
+    if file_name.endswith(".csv"):
+        with open(file_name, newline="") as file:
+            jobs = [_Parse_CSV_Job(row) for row in csv.DictReader(file)]
+    else:
+        with open(file_name) as file:
+            manifest = json.load(file)
+        if isinstance(manifest, dict):
+            defaults.update(manifest.get("defaults", {}))
+            manifest = manifest["jobs"]
+        jobs = manifest
+
+    # Paths of the manifest are relative to its folder
+    manifest_folder = os.path.dirname(os.path.abspath(file_name))
+    full_jobs = []
+    for job in jobs:
+        job = {**defaults, **job}
+        if "input" not in job:
+            raise ValueError(f"Job without input in {file_name}: {job}")
+        unknown = [method for method in job["methods"] if method not in METHOD_OUTPUTS]
+        if unknown:
+            raise ValueError(f"Unknown methods {unknown} in job {job['input']}, expected {list(METHOD_OUTPUTS)}")
+        job["input"] = os.path.join(manifest_folder, job["input"])
+        job["output_folder"] = os.path.join(manifest_folder, job["output_folder"], "")
+        if job["cache_folder"] is not None:
+            job["cache_folder"] = os.path.join(manifest_folder, job["cache_folder"])
+        job.setdefault("title", os.path.splitext(os.path.basename(job["input"]))[0])
+        full_jobs.append(job)
+
+    titles = [job["title"] for job in full_jobs]
+    repeated = {title for title in titles if titles.count(title) > 1}
+    if repeated:
+        raise ValueError(f"Repeated job titles (outputs would be overwritten): {sorted(repeated)}")
+    return full_jobs
+
+def _Parse_CSV_Job(row):
+    # Empty cells take the default value
+    job = {key: value for key, value in row.items() if value not in (None, "")}
+    if "shape" in job:
+        job["shape"] = [int(size) for size in job["shape"].lower().split("x")]
+    if "methods" in job:
+        job["methods"] = [method.strip() for method in job["methods"].split(";") if method.strip()]
+    for key in ("fluid_default_value", "memory_budget"):
+        if key in job:
+            job[key] = int(float(job[key]))
+    for key in ("plots", "trace_memory"):
+        if key in job:
+            job[key] = job[key].strip().lower() in ("1", "true", "yes")
+    return job
+
+
+def Job_Outputs(job):
+    # Output files of the job, in the order of its methods
+    base = job["output_folder"] + "raw/" + job["title"]
+    return [base + suffix for method in job["methods"] for suffix in METHOD_OUTPUTS[method]]
+
+def Done_Marker_File_Name(job):
+    return job["output_folder"] + "done/" + job["title"] + ".json"
+
+def Job_Hash(job):
+    # Changing any setting of a job (or its input file) invalidates its previous results
+    settings = {key: job[key] for key in sorted(job) if key not in ("plots", "trace_memory", "cache_folder")}
+    settings["input_size"] = os.path.getsize(job["input"]) if os.path.exists(job["input"]) else None
+    settings["input_mtime"] = os.path.getmtime(job["input"]) if os.path.exists(job["input"]) else None
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def Job_Is_Done(job):
+    """
+    A job is complete if its done marker exists, was written for the same settings, and all the
+    outputs it lists still exist with their recorded sizes. Jobs interrupted by a crash have no marker:
+    Run_Job removes it before starting, and outputs only get their final names once the job finished.
+    """
+    marker_file = Done_Marker_File_Name(job)
+    if not os.path.exists(marker_file):
+        return False
+    try:
+        with open(marker_file) as file:
+            marker = json.load(file)
+    except (OSError, ValueError):
+        return False
+    if marker.get("job_hash") != Job_Hash(job):
+        return False
+    return all(os.path.exists(output) and os.path.getsize(output) == size for output, size in marker["outputs"].items()) \
+        and set(marker["outputs"]) == set(Job_Outputs(job))
+
+def Write_Done_Marker(job, result):
+    marker_file = Done_Marker_File_Name(job)
+    os.makedirs(os.path.dirname(marker_file), exist_ok=True)
+    marker = {**result,
+              "job_hash": Job_Hash(job),
+              "outputs": {output: os.path.getsize(output) for output in Job_Outputs(job)}}
+
+    # Written to a temporary file and renamed, so that a crash never leaves a partial marker
+    temporary_file = marker_file + ".tmp"
+    with open(temporary_file, "w") as file:
+        json.dump(marker, file, indent=4)
+    os.replace(temporary_file, marker_file)
+
+
+def Run_Job(job):
+    """
+    Runs the interpolation methods of a job (in a worker process) and writes its run report and done marker.
+    Outputs are written with a ".partial" name and renamed when every method finished, since the output
+    files are preallocated at full size: an interrupted job never leaves files with the final names.
+
+    Returns:
+        dict: Row of the summary table.
+    """
+    # Imported here: the interpolation modules (and plotting) are only loaded by the workers
+    from Interpolation_Algorithms import interpolate_solid, interpolate_solid_connections, \
+        interpolate_solid_connection_surfaces, interpolate_solid_connection_surfaces_geodesic
+    from Instrumentation import Peak_RSS
+
+    title, output_folder = job["title"], job["output_folder"]
+    base = output_folder + "raw/" + title + ".partial"
+    os.makedirs(output_folder + "raw/", exist_ok=True)
+
+    # The previous results are not complete anymore once the job starts again
+    marker_file = Done_Marker_File_Name(job)
+    if os.path.exists(marker_file):
+        os.remove(marker_file)
+
+    start = time.perf_counter()
+    report_file_name = output_folder + "reports/" + title + "_report.json"
+    with Instrumented_Run(report_file_name, trace_memory=job["trace_memory"], volume=job["input"], title=title):
+        volume, metadata = Open_Volume(job["input"], volume_shape=job["shape"], fluid_default_value=job["fluid_default_value"])
+        fluid = metadata["fluid_default_value"]
+        # Jobs can share a cache folder (e.g. reruns of a sweep with other methods). Not used by the slab mode
+        cache = ResultCache(job["cache_folder"]) if job["cache_folder"] is not None else None
+
+        for method in job["methods"]:
+            print(title, ": ", method)
+            if method == "solid":
+                domains = interpolate_solid(volume, fluid_default_value=fluid, file_name=base)
+            elif method == "solid_connections":
+                domains = interpolate_solid_connections(volume, fluid_default=fluid, file_name=base, make_plot=False, cache=cache)
+            elif method == "surfaces":
+                domains = interpolate_solid_connection_surfaces(volume, fluid_default=fluid, file_name=base,
+                                                                make_plot=job["plots"] and job["memory_budget"] is None,
+                                                                memory_budget=job["memory_budget"],
+                                                                cache=cache if job["memory_budget"] is None else None)
+            else:
+                domains = (interpolate_solid_connection_surfaces_geodesic(volume, fluid_default=fluid, file_name=base),)
+
+            if job["plots"]:
+                from Plotter import Plot_Domain
+                for suffix, domain in zip(METHOD_OUTPUTS[method], domains):
+                    Plot_Domain(domain, output_folder + "png/" + title + suffix[:-len(".raw")], remove_value=[fluid])
+            del domains
+
+    # Every method finished: outputs (and their sidecars) get their final names
+    partial_outputs = [base + suffix for method in job["methods"] for suffix in METHOD_OUTPUTS[method]]
+    for partial_output, output in zip(partial_outputs, Job_Outputs(job)):
+        os.replace(partial_output, output)
+        os.replace(Metadata_File_Name(partial_output), Metadata_File_Name(output))
+
+    result = {"title": title,
+              "input": job["input"],
+              "status": "done",
+              "wall_time_s": time.perf_counter() - start,
+              "peak_rss_bytes": Peak_RSS(),
+              "methods": ";".join(job["methods"]),
+              "outputs": ";".join(Job_Outputs(job)),
+              "error": "",
+              "date": datetime.datetime.now().isoformat(timespec="seconds")}
+    Write_Done_Marker(job, result)
+    return result
+
+
+def Run_Batch(jobs, summary_file_name, n_workers=1, force=False):
+    """
+    Runs the jobs across n_workers processes, skipping those already complete (see Job_Is_Done) unless
+    force. A failed job does not stop the others, also if its process is killed (e.g. out of memory). The summary table (one row per job, with its wall
+    time) is rewritten as jobs finish, so that it is up to date if the batch is interrupted.
+
+    Returns:
+        list: Rows of the summary table.
+    """
+    rows = {}
+    pending = []
+    for job in jobs:
+        if not force and Job_Is_Done(job):
+            with open(Done_Marker_File_Name(job)) as file:
+                marker = json.load(file)
+            rows[job["title"]] = {**{field: marker.get(field, "") for field in SUMMARY_FIELDS},
+                                  "status": "skipped", "outputs": ";".join(marker["outputs"])}
+        else:
+            pending.append(job)
+    print("Batch: ", len(jobs), " jobs, ", len(jobs) - len(pending), " already complete")
+    Write_Summary(summary_file_name, jobs, rows)
+
+    # A new process per job: spawn does not inherit the memory of the previous jobs, and a job killed by
+    # the system (e.g. out of memory) or crashing the interpreter only fails itself
+    context = multiprocessing.get_context("spawn")
+    running = {}
+    while pending or running:
+        while pending and len(running) < n_workers:
+            job = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_Job_Process, args=(job, sender), name="Job " + job["title"])
+            process.start()
+            sender.close()
+            running[process.sentinel] = (process, receiver, job)
+
+        for sentinel in wait(list(running)):
+            process, receiver, job = running.pop(sentinel)
+            message = receiver.recv() if receiver.poll() else None
+            process.join()
+            receiver.close()
+            status, value = message or ("failed", f"Worker process terminated with exit code {process.exitcode}")
+
+            if status == "done":
+                rows[job["title"]] = value
+            else:
+                rows[job["title"]] = {"title": job["title"], "input": job["input"], "status": "failed", "wall_time_s": "",
+                                      "peak_rss_bytes": "", "methods": ";".join(job["methods"]), "outputs": "", "error": value}
+            print("Job ", job["title"], ": ", rows[job["title"]]["status"], " (", len(rows), "/", len(jobs), ")")
+            Write_Summary(summary_file_name, jobs, rows)
+
+    return [rows[job["title"]] for job in jobs]
+
+def _Job_Process(job, connection):
+    # Target of the job processes: sends ("done", row) or ("failed", error) to Run_Batch
+    try:
+        message = ("done", Run_Job(job))
+    except Exception as error:
+        traceback.print_exception(error)
+        message = ("failed", f"{type(error).__name__}: {error}")
+    connection.send(message)
+    connection.close()
+
+def Write_Summary(file_name, jobs, rows):
+    # Rows in the order of the manifest; jobs not finished yet are "pending"
+    folder = os.path.dirname(file_name)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(file_name, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for job in jobs:
+            writer.writerow(rows.get(job["title"], {"title": job["title"], "input": job["input"], "status": "pending",
+                                                    "methods": ";".join(job["methods"])}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch interpolation of the volumes listed in a manifest")
+    parser.add_argument("manifest", help="JSON or CSV file with the jobs (see Read_Manifest)")
+    parser.add_argument("--workers", type=int, default=1, help="Jobs run at the same time")
+    parser.add_argument("--summary", default="", help="Summary table (default: <manifest>_summary.csv)")
+    parser.add_argument("--force", action="store_true", help="Run again the jobs already complete")
+    args = parser.parse_args()
+
+    jobs = Read_Manifest(args.manifest)
+    summary_file_name = args.summary or os.path.splitext(args.manifest)[0] + "_summary.csv"
+    rows = Run_Batch(jobs, summary_file_name, n_workers=args.workers, force=args.force)
+
+    failed = [row["title"] for row in rows if row["status"] == "failed"]
+    print("Summary saved in ", summary_file_name)
+    if failed:
+        print("Failed jobs: ", failed)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import numpy as np
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Array_Utilities import Remove_Internal_Solid
+from Interpolation_Algorithms import interpolate_solid_connection_surfaces
+from Result_Cache import ResultCache
+from Instrumentation import Enable_Instrumentation, Disable_Instrumentation, Run_Report, Peak_RSS
+from main_CreateRockVolumes import create_array_with_single_plane, create_array_with_parallel_planes
+
+# Stages of the surface pipeline (interpolate_solid_connection_surfaces) and the instrumentation timer of each
+STAGE_TIMERS = {"surface_extraction": "surface_extraction",
+                "component_labelling": "component_labelling",
+                "sample_extraction": "sample_extraction",
+                "kriging": "Apply_Kriging",
+                "nearest_neighbor": "Apply_NearestNeighbor",
+                "merge": "merge",
+                "cache_write": "cache_write",
+                "write": "write"}
+STAGES = list(STAGE_TIMERS)
+
+
+def Build_Benchmark_Volume(size, n_components, sample_density, folder, seed=0):
+    """
+    Builds a size**3 volume with n_components solid plates perpendicular to the first axis (the
+    generators of main_CreateRockVolumes for 1 and 2 plates), and turns a fraction sample_density of
+    the surface cells into samples with random angles. The same arguments give the same volume.
+    """
+    shape = (size, size, size)
+    thickness = max(2, size // 10)
+    if n_components == 1:
+        volume = create_array_with_single_plane([], shape, plane_axis=0, thickness=thickness)
+    elif n_components == 2:
+        volume = create_array_with_parallel_planes([], shape, plane_axis=0, thickness=thickness,
+                                                   file_path=os.path.join(folder, "generated"))
+    else:
+        # Plates evenly spaced along the first axis, separated by at least one fluid plane
+        spacing = size // n_components
+        if spacing < 2:
+            raise ValueError(f"{n_components} plates do not fit in a volume of size {size}")
+        volume = np.ones(shape, dtype=np.uint8)
+        for plate in range(n_components):
+            volume[plate*spacing: plate*spacing + min(thickness, spacing - 1)] = 0
+
+    # Amostras aleatorias na superficie do solido
+    rng = np.random.default_rng(seed)
+    surface_cells = np.argwhere(Remove_Internal_Solid(volume) == 0)
+    n_samples = min(max(int(round(sample_density * len(surface_cells))), 3), len(surface_cells))
+    chosen = surface_cells[rng.choice(len(surface_cells), n_samples, replace=False)]
+    volume[tuple(chosen.T)] = rng.integers(5, 180, n_samples)
+    return volume
+
+
+def Run_Surface_Pipeline(volume, output_folder, fluid_default=1, kriging_neighbors=None, n_workers=1, cache=True, trace_memory=False):
+    """
+    Runs interpolate_solid_connection_surfaces as main.Interpolation_Progress does (outputs written to
+    output_folder, result cache starting empty), and reads the time of each stage from its instrumentation
+    timers. Stages run by worker processes (n_workers > 1) are not timed.
+
+    Returns:
+        tuple: Time (s) and tracemalloc peak (bytes, if tracing) of each stage, total time and number of groups.
+    """
+    result_cache = None
+    if cache:
+        result_cache = ResultCache(os.path.join(output_folder, "cache"))
+        result_cache.clear()
+
+    Enable_Instrumentation(trace_memory)
+    try:
+        interpolate_solid_connection_surfaces(volume, fluid_default=fluid_default, file_name=os.path.join(output_folder, "benchmark"), make_plot=False,
+                                              n_workers=n_workers, cache=result_cache, kriging_neighbors=kriging_neighbors)
+        report = Run_Report()
+    finally:
+        Disable_Instrumentation()
+
+    # A stage is the sum of its timers, wherever they are nested
+    timer_stages = {timer: stage for stage, timer in STAGE_TIMERS.items()}
+    timings, memory_peaks = {stage: 0.0 for stage in STAGES}, {}
+    for path, record in report["timers"].items():
+        stage = timer_stages.get(path.split("/")[-1])
+        if stage is None:
+            continue
+        timings[stage] += record["total_s"]
+        if "tracemalloc_peak_bytes" in record:
+            memory_peaks[stage] = max(memory_peaks.get(stage, 0), record["tracemalloc_peak_bytes"])
+
+    total_time = report["timers"]["interpolate_solid_connection_surfaces"]["total_s"]
+    return timings, memory_peaks, total_time, report["counters"].get("components", 0)
+
+
+def Run_Benchmark_Case(size, n_components, sample_density, kriging_neighbors=None, n_workers=1, cache=True, repeat=1,
+                       trace_memory=False, seed=0):
+    # Runs in its own process, so that the peak RSS belongs to this case only
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        volume = Build_Benchmark_Volume(size, n_components, sample_density, folder, seed=seed)
+        generation_time = time.perf_counter() - start
+
+        runs, totals = [], []
+        for _ in range(repeat):
+            timings, memory_peaks, total_time, n_groups = Run_Surface_Pipeline(volume, folder, kriging_neighbors=kriging_neighbors,
+                                                                               n_workers=n_workers, cache=cache, trace_memory=trace_memory)
+            runs.append(timings)
+            totals.append(total_time)
+
+    # Best of the repetitions, per stage
+    stage_times = {name: min(run[name] for run in runs) for name in STAGES}
+    return {"size": size,
+            "n_components": n_components,
+            "sample_density": sample_density,
+            "kriging_neighbors": kriging_neighbors,
+            "n_workers": n_workers,
+            "cache": cache,
+            "n_groups": n_groups,
+            "n_samples": int(np.sum((volume != 0) & (volume != 1))),
+            "n_solid_cells": int(np.sum(volume != 1)),
+            "volume_generation_s": generation_time,
+            "stage_times_s": stage_times,
+            "total_time_s": min(totals),
+            "tracemalloc_peak_bytes": memory_peaks if trace_memory else None,
+            "peak_rss_bytes": Peak_RSS()}
+
+
+def Git_Commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Compare_Benchmarks(current, reference):
+    # Prints, for the cases present in both results, the time ratio of each stage (current / reference)
+    key = lambda case: (case["size"], case["n_components"], case["sample_density"], case["kriging_neighbors"], case.get("n_workers", 1))
+    reference_cases = {key(case): case for case in reference["cases"]}
+    for case in current["cases"]:
+        if key(case) not in reference_cases:
+            continue
+        old = reference_cases[key(case)]
+        ratios = {name: case["stage_times_s"][name] / old["stage_times_s"][name]
+                  for name in STAGES if old["stage_times_s"].get(name, 0) > 0}
+        print(key(case), " total: ", round(case["total_time_s"] / old["total_time_s"], 2),
+              {name: round(ratio, 2) for name, ratio in ratios.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the surface interpolation pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25, 50, 100, 200],
+                        help="Volume edges (larger volumes with global kriging take long: use --kriging-neighbors)")
+    parser.add_argument("--densities", type=float, nargs="+", default=[0.0005, 0.005],
+                        help="Fraction of the surface cells that are samples")
+    parser.add_argument("--components", type=int, nargs="+", default=[1, 2, 8])
+    parser.add_argument("--kriging-neighbors", type=int, default=0, help="Local kriging neighbors (0 for global kriging, as main.py)")
+    parser.add_argument("--workers", type=int, default=1, help="Processes of the pipeline (its stages are only timed with 1)")
+    parser.add_argument("--no-cache", action="store_true", help="Run without the result cache used by main.py")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true", help="Record the tracemalloc peak of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="Results file (default: Benchmarks/benchmark_<commit>.json)")
+    parser.add_argument("--compare", default="", help="Previous results file to compare with")
+    args = parser.parse_args()
+
+    commit = Git_Commit()
+    output = args.output or os.path.join("Benchmarks", f"benchmark_{(commit or 'unknown')[:10]}.json")
+    results = {"commit": commit,
+               "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "cases": []}
+
+    # A new process per case: spawn does not inherit the memory of the previous cases
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        for n_components in args.components:
+            for density in args.densities:
+                print(f"Benchmark: size {size}, components {n_components}, sample density {density}")
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    try:
+                        case = executor.submit(Run_Benchmark_Case, size, n_components, density, args.kriging_neighbors or None,
+                                               args.workers, not args.no_cache, args.repeat, args.trace_memory, args.seed).result()
+                    except ValueError as error:
+                        print("---Skipped: ", error)
+                        continue
+                print("---Total: ", round(case["total_time_s"], 3), " s, peak RSS: ", (case["peak_rss_bytes"] or 0) // 2**20, " MB")
+                results["cases"].append(case)
+
+                # Written after every case, so that partial results are kept
+                folder = os.path.dirname(output)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                with open(output, "w") as file:
+                    json.dump(results, file, indent=4)
+
+    print("Results saved in ", output)
+    if args.compare:
+        with open(args.compare) as file:
+            Compare_Benchmarks(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import numpy as np
 import Plotter as pl
 import math
 import os
+from Volume_IO import Save_Volume
 
 
 # === MODULE FUNCTIONS ===
@@ -39,7 +40,7 @@ def create_centered_cube(domain_shape, cube_shape, points, file_path):
         domain[int(x), int(y), int(z)] = value
     
 
-    domain.tofile(file_path + ".raw")
+    Save_Volume(file_path + ".raw", domain)
     print(f"Volume salvo como {file_path}.raw")
     return domain
 
@@ -87,7 +88,7 @@ def create_array_with_parallel_planes(points, shape, plane_axis, thickness, file
         os.makedirs(folder)
     
     # Salvar o array em um arquivo .raw
-    array.tofile(file_path + ".raw")
+    Save_Volume(file_path + ".raw", array)
     print(f"Volume salvo como {file_path}.raw")
     return array
 
@@ -133,7 +134,7 @@ def create_array_with_single_plane(points, shape, plane_axis, thickness, file_pa
         
         
         # Salvar o array em um arquivo .raw
-        array.tofile(file_path + ".raw")
+        Save_Volume(file_path + ".raw", array)
         print(f"Volume salvo como {file_path}.raw")
     return array
     
@@ -237,7 +238,7 @@ def create_plane_with_circles(shape, plane, spacing, radius1, radius2, value1, v
 
     # Salvar o volume gerado como arquivo .raw, se o caminho for fornecido
     if file_path:
-        array.tofile(file_path + ".raw")
+        Save_Volume(file_path + ".raw", array)
         print(f"Volume salvo como {file_path}.raw")
 
     return array
@@ -297,7 +298,7 @@ def create_array_with_c_plane(points, shape, plane_axis, thickness, file_path, c
         os.makedirs(folder)
 
     # Save the array to a .raw file
-    array.tofile(file_path + ".raw")
+    Save_Volume(file_path + ".raw", array)
     print(f"Volume saved as {file_path}.raw")
     return array
 # === AUXILIARY FUNCTIONS ===
@@ -419,136 +420,137 @@ def generate_angle_points_example_12(cube_length, c_cut_size):
 # MAKE SURE THE SAMPLES ARE CONNECTED TO SOLID SURFACE
 
 # === EXAMPLES ===
-cube_length = 25
-# Computation
-volume_shape = (cube_length, cube_length, cube_length)
-
-"""
-# Example 1: Cube in the center and samples in his corners (n)
-points = generate_angle_points_example_1(cube_length)
-array_ex1 = create_centered_cube(domain_shape=volume_shape, cube_shape=volume_shape, points=points, file_path="Rock Volumes/Example_1")
-pl.Plot_Domain(array_ex1, "Rock Volumes/Example_1_SolidRock", remove_value=[1]) 
-
-# Example 2: Cube in the center and samples in his corners (n)
-points = generate_angle_points_example_2(cube_length)
-array_ex2 = create_centered_cube(domain_shape=volume_shape, cube_shape=volume_shape, points=points, file_path="Rock Volumes/Example_2")
-pl.Plot_Domain(array_ex2, "Rock Volumes/Example_2_SolidRock", remove_value=[1]) 
-
-# Example 4: Plane with 2 samples in each face (Problem: oposit sample in other face is closer than others)
-points = generate_angle_points_example_4(cube_length, thickness=5)
-array_ex6 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_4")
-pl.Plot_Domain(array_ex6, "Rock Volumes/Example_4_SolidRock", remove_value=[1])
-
-# Example 5: Plane with 4 centered/grouped samples
-points = generate_angle_points_example_5(cube_length)
-array_ex5 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_5")
-pl.Plot_Domain(array_ex5, "Rock Volumes/Example_5_SolidRock", remove_value=[1])
-
-# Example 6: Plane with 2 samples in each face (Problem solved (4))
-points = generate_angle_points_example_6(cube_length, thickness=5)
-array_ex6 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_6")
-pl.Plot_Domain(array_ex6, "Rock Volumes/Example_6_SolidRock", remove_value=[1])
-
-# Example 7: Parallel planes with 4 Samples each. As they too close and very thick, the parallel face influenciate too much
-thickness=11
-points = generate_angle_points_example_7(cube_length, thickness)
-array_ex7 = create_array_with_parallel_planes(points=points, shape=volume_shape, plane_axis=0, thickness=thickness, file_path="Rock Volumes/Example_7")
-pl.Plot_Domain(array_ex7, "Rock Volumes/Example_7_SolidRock", remove_value=[1])
-
-# Example 8: Parallel planes with 4 samples on each face.
-thickness = 5
-plane_axis = 0
-points = generate_angle_points_example_8(cube_length, thickness=thickness)
-array_ex8 = create_array_with_parallel_planes(points=points, shape=volume_shape, plane_axis=plane_axis, thickness=thickness, file_path="Rock Volumes/Example_8")
-pl.Plot_Domain(array_ex8, "Rock Volumes/Example_8_SolidRock", remove_value=[1])
-
-
-# Example 9: Circles too close to each other, so that the kriging fails
-plane = "XY"
-cube_length = 50
-spacing = 2
-radius1 = 9
-radius2 = 9
-value1 = 50
-value2 = 100
-num_points1 = 8  # Número de pontos no perímetro do primeiro círculo
-num_points2 = 8  # Número de pontos no perímetro do segundo círculo
-volume_shape = (cube_length, cube_length, cube_length)
-array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
-                                      radius1=radius1, radius2=radius2, value1=value1, 
-                                      value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_9")
-pl.Plot_Domain(array_ex9, "Rock Volumes/Example_9_SolidRock", remove_value=[1])
-
-# Example 10: Circles poorly samples, so that the kriging fails
-plane = "XY"
-cube_length = 50
-spacing = 10
-radius1 = 9
-radius2 = 9
-value1 = 50
-value2 = 100
-num_points1 = 4  # Número de pontos no perímetro do primeiro círculo
-num_points2 = 4  # Número de pontos no perímetro do segundo círculo
-volume_shape = (cube_length, cube_length, cube_length)
-array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
-                                      radius1=radius1, radius2=radius2, value1=value1, 
-                                      value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_10")
-pl.Plot_Domain(array_ex9, "Rock Volumes/Example_10_SolidRock", remove_value=[1])
-
-# Example 11: Circles separated and with enough samples, so that the kriging suceed
-plane = "XY"
-cube_length = 50
-spacing = 10
-radius1 = 9
-radius2 = 9
-value1 = 50
-value2 = 100
-num_points1 = 8  # Número de pontos no perímetro do primeiro círculo
-num_points2 = 8  # Número de pontos no perímetro do segundo círculo
-volume_shape = (cube_length, cube_length, cube_length)
-array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
-                                      radius1=radius1, radius2=radius2, value1=value1, 
-                                      value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_11")
-pl.Plot_Domain(array_ex9, "Rock Volumes/Example_11_SolidRock", remove_value=[1])
-"""
-"""
-# Example 12
-cut_size = cube_length // 6
-points = generate_angle_points_example_12(volume_shape[0], cut_size)
-array_ex12 = create_array_with_c_plane(points, shape=volume_shape, plane_axis=0, thickness=4, c_cut_size=cut_size, file_path="Rock Volumes/Example_12")
-pl.Plot_Domain(array_ex12, "Rock Volumes/Example_12_SolidRock", remove_value=[1])
-"""
-
-# Example 13: Circles too close to each other, so that the kriging fails
-plane = "XY"
-cube_length = 50
-spacing = 2
-radius1 = 9
-radius2 = 12
-value1 = 50
-value2 = 100
-num_points1 = 2  # Número de pontos no perímetro do primeiro círculo
-num_points2 = 2  # Número de pontos no perímetro do segundo círculo
-volume_shape = (cube_length, cube_length, cube_length)
-array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
-                                      radius1=radius1, radius2=radius2, value1=value1, 
-                                      value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_13")
-pl.Plot_Domain(array_ex9, "Rock Volumes/Example_13_SolidRock", remove_value=[1])
-
-"""
-# Example 14: Circles poorly samples, so that the kriging fails
-plane = "XY"
-cube_length = 50
-spacing = 10
-radius1 = 9
-radius2 = 12
-value1 = 50
-value2 = 100
-num_points1 = 2  # Número de pontos no perímetro do primeiro círculo
-num_points2 = 2  # Número de pontos no perímetro do segundo círculo
-volume_shape = (cube_length, cube_length, cube_length)
-array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
-                                      radius1=radius1, radius2=radius2, value1=value1, 
-                                      value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_14")
-pl.Plot_Domain(array_ex9, "Rock Volumes/Example_14_SolidRock", remove_value=[1])
-"""
\ No newline at end of file
+if __name__ == "__main__":
+    cube_length = 25
+    # Computation
+    volume_shape = (cube_length, cube_length, cube_length)
+
+    """
+    # Example 1: Cube in the center and samples in his corners (n)
+    points = generate_angle_points_example_1(cube_length)
+    array_ex1 = create_centered_cube(domain_shape=volume_shape, cube_shape=volume_shape, points=points, file_path="Rock Volumes/Example_1")
+    pl.Plot_Domain(array_ex1, "Rock Volumes/Example_1_SolidRock", remove_value=[1]) 
+
+    # Example 2: Cube in the center and samples in his corners (n)
+    points = generate_angle_points_example_2(cube_length)
+    array_ex2 = create_centered_cube(domain_shape=volume_shape, cube_shape=volume_shape, points=points, file_path="Rock Volumes/Example_2")
+    pl.Plot_Domain(array_ex2, "Rock Volumes/Example_2_SolidRock", remove_value=[1]) 
+
+    # Example 4: Plane with 2 samples in each face (Problem: oposit sample in other face is closer than others)
+    points = generate_angle_points_example_4(cube_length, thickness=5)
+    array_ex6 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_4")
+    pl.Plot_Domain(array_ex6, "Rock Volumes/Example_4_SolidRock", remove_value=[1])
+
+    # Example 5: Plane with 4 centered/grouped samples
+    points = generate_angle_points_example_5(cube_length)
+    array_ex5 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_5")
+    pl.Plot_Domain(array_ex5, "Rock Volumes/Example_5_SolidRock", remove_value=[1])
+
+    # Example 6: Plane with 2 samples in each face (Problem solved (4))
+    points = generate_angle_points_example_6(cube_length, thickness=5)
+    array_ex6 = create_array_with_single_plane(points=points, shape=volume_shape, plane_axis=0, thickness=5, file_path="Rock Volumes/Example_6")
+    pl.Plot_Domain(array_ex6, "Rock Volumes/Example_6_SolidRock", remove_value=[1])
+
+    # Example 7: Parallel planes with 4 Samples each. As they too close and very thick, the parallel face influenciate too much
+    thickness=11
+    points = generate_angle_points_example_7(cube_length, thickness)
+    array_ex7 = create_array_with_parallel_planes(points=points, shape=volume_shape, plane_axis=0, thickness=thickness, file_path="Rock Volumes/Example_7")
+    pl.Plot_Domain(array_ex7, "Rock Volumes/Example_7_SolidRock", remove_value=[1])
+
+    # Example 8: Parallel planes with 4 samples on each face.
+    thickness = 5
+    plane_axis = 0
+    points = generate_angle_points_example_8(cube_length, thickness=thickness)
+    array_ex8 = create_array_with_parallel_planes(points=points, shape=volume_shape, plane_axis=plane_axis, thickness=thickness, file_path="Rock Volumes/Example_8")
+    pl.Plot_Domain(array_ex8, "Rock Volumes/Example_8_SolidRock", remove_value=[1])
+
+
+    # Example 9: Circles too close to each other, so that the kriging fails
+    plane = "XY"
+    cube_length = 50
+    spacing = 2
+    radius1 = 9
+    radius2 = 9
+    value1 = 50
+    value2 = 100
+    num_points1 = 8  # Número de pontos no perímetro do primeiro círculo
+    num_points2 = 8  # Número de pontos no perímetro do segundo círculo
+    volume_shape = (cube_length, cube_length, cube_length)
+    array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
+                                          radius1=radius1, radius2=radius2, value1=value1, 
+                                          value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_9")
+    pl.Plot_Domain(array_ex9, "Rock Volumes/Example_9_SolidRock", remove_value=[1])
+
+    # Example 10: Circles poorly samples, so that the kriging fails
+    plane = "XY"
+    cube_length = 50
+    spacing = 10
+    radius1 = 9
+    radius2 = 9
+    value1 = 50
+    value2 = 100
+    num_points1 = 4  # Número de pontos no perímetro do primeiro círculo
+    num_points2 = 4  # Número de pontos no perímetro do segundo círculo
+    volume_shape = (cube_length, cube_length, cube_length)
+    array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
+                                          radius1=radius1, radius2=radius2, value1=value1, 
+                                          value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_10")
+    pl.Plot_Domain(array_ex9, "Rock Volumes/Example_10_SolidRock", remove_value=[1])
+
+    # Example 11: Circles separated and with enough samples, so that the kriging suceed
+    plane = "XY"
+    cube_length = 50
+    spacing = 10
+    radius1 = 9
+    radius2 = 9
+    value1 = 50
+    value2 = 100
+    num_points1 = 8  # Número de pontos no perímetro do primeiro círculo
+    num_points2 = 8  # Número de pontos no perímetro do segundo círculo
+    volume_shape = (cube_length, cube_length, cube_length)
+    array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
+                                          radius1=radius1, radius2=radius2, value1=value1, 
+                                          value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_11")
+    pl.Plot_Domain(array_ex9, "Rock Volumes/Example_11_SolidRock", remove_value=[1])
+    """
+    """
+    # Example 12
+    cut_size = cube_length // 6
+    points = generate_angle_points_example_12(volume_shape[0], cut_size)
+    array_ex12 = create_array_with_c_plane(points, shape=volume_shape, plane_axis=0, thickness=4, c_cut_size=cut_size, file_path="Rock Volumes/Example_12")
+    pl.Plot_Domain(array_ex12, "Rock Volumes/Example_12_SolidRock", remove_value=[1])
+    """
+
+    # Example 13: Circles too close to each other, so that the kriging fails
+    plane = "XY"
+    cube_length = 50
+    spacing = 2
+    radius1 = 9
+    radius2 = 12
+    value1 = 50
+    value2 = 100
+    num_points1 = 2  # Número de pontos no perímetro do primeiro círculo
+    num_points2 = 2  # Número de pontos no perímetro do segundo círculo
+    volume_shape = (cube_length, cube_length, cube_length)
+    array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
+                                          radius1=radius1, radius2=radius2, value1=value1, 
+                                          value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_13")
+    pl.Plot_Domain(array_ex9, "Rock Volumes/Example_13_SolidRock", remove_value=[1])
+
+    """
+    # Example 14: Circles poorly samples, so that the kriging fails
+    plane = "XY"
+    cube_length = 50
+    spacing = 10
+    radius1 = 9
+    radius2 = 12
+    value1 = 50
+    value2 = 100
+    num_points1 = 2  # Número de pontos no perímetro do primeiro círculo
+    num_points2 = 2  # Número de pontos no perímetro do segundo círculo
+    volume_shape = (cube_length, cube_length, cube_length)
+    array_ex9 = create_plane_with_circles(shape=volume_shape, plane=plane, spacing=spacing,
+                                          radius1=radius1, radius2=radius2, value1=value1, 
+                                          value2=value2, num_points1=num_points1, num_points2=num_points2,file_path="Rock Volumes/Example_14")
+    pl.Plot_Domain(array_ex9, "Rock Volumes/Example_14_SolidRock", remove_value=[1])
+    """
\ No newline at end of file
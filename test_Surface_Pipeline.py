@@ -0,0 +1,48 @@
+import numpy as np
+import os
+from Array_Utilities import Remove_Internal_Solid
+from Interpolation_Algorithms import interpolate_solid_connection_surfaces, interpolate_solid_connection_surfaces_update
+
+FLUID = 255
+
+
+def Build_Volume(seed=0):
+    # Two solid plates (with internal cells) in fluid coded as 255, samples on their surface
+    volume = np.full((20, 20, 20), FLUID, dtype=np.uint8)
+    volume[2:7] = 0
+    volume[12:17] = 0
+    rng = np.random.default_rng(seed)
+    surface_cells = np.argwhere(Remove_Internal_Solid(volume, fluid_default_value=FLUID) == 0)
+    chosen = surface_cells[rng.choice(len(surface_cells), 40, replace=False)]
+    volume[tuple(chosen.T)] = rng.integers(5, 180, len(chosen))
+    return volume
+
+
+def test_slab_mode_equals_in_core(tmp_path):
+    volume = Build_Volume()
+    krig, nn = interpolate_solid_connection_surfaces(volume.copy(), fluid_default=FLUID)
+    slab_krig, slab_nn = interpolate_solid_connection_surfaces(volume.copy(), fluid_default=FLUID, file_name=os.path.join(tmp_path, "slabs"),
+                                                               memory_budget=2*10**5)
+
+    # Internal solid cells are fluid in the results
+    internal = (Remove_Internal_Solid(volume, fluid_default_value=FLUID) == FLUID) & (volume != FLUID)
+    assert np.any(internal) and np.all(krig[internal] == FLUID)
+    assert np.array_equal(krig, slab_krig)
+    assert np.array_equal(nn, slab_nn)
+
+
+def test_update_equals_full_run():
+    volume = Build_Volume()
+    krig, nn = interpolate_solid_connection_surfaces(volume.copy(), fluid_default=FLUID)
+
+    samples = np.argwhere((volume != 0) & (volume != FLUID))
+    changed = samples[:3]
+    changes = {"x": changed[:, 0], "y": changed[:, 1], "z": changed[:, 2], "angle": np.array([30, 120, 0], dtype=np.uint8)}
+    new_volume = volume.copy()
+    new_volume[tuple(changed.T)] = changes["angle"]
+    full_krig, full_nn = interpolate_solid_connection_surfaces(new_volume.copy(), fluid_default=FLUID)
+
+    interpolate_solid_connection_surfaces_update(volume, changes, krig, nn, fluid_default=FLUID)
+    assert np.array_equal(volume, new_volume)
+    assert np.array_equal(krig, full_krig)
+    assert np.array_equal(nn, full_nn)